@@ -0,0 +1,424 @@
+
+import os
+import gc
+import sys
+import json
+import types
+import random
+import platform
+import resource
+import argparse
+
+from array import array
+from time import time as now, strftime
+
+from job import Job
+from jobarray import JobArray
+from daemon import Daemon
+from handler import Handler
+from communicator import Communicator
+from scheduler import FairShareQueue
+
+
+#
+# Benchmarks
+#
+#   python benchmark.py daemon --jobs 100000 --hosts 1000 --output bench.jsonl
+#   python benchmark.py daemon --project big:20000 --project small:2000 \
+#                              --weight small:2 --quota big:400 --runtime 0.5
+#   python benchmark.py finished-jobs --jobs 1000
+#   python benchmark.py compare bench.jsonl
+#
+# The daemon benchmark drives Daemon.core with a simulated cluster, see
+# SimulatedHandler and RecordingCommunicator. Results are appended as one
+# JSON object per line to the output file, compare shows the change of
+# every metric between the last two results of the same benchmark.
+#
+# With --project the jobs belong to several projects, which submit their
+# jobs in parallel, and are scheduled by a FairShareQueue with the given
+# weights and quotas. The share of the running cores of every project is
+# sampled over time.
+#
+# Memory of objects is measured by following their references (see
+# deep_sizeof), so that the numbers don't depend on the allocator.
+#
+
+def deep_sizeof(obj):
+    # Bytes of obj and of all objects reachable from it, classes, modules
+    # and functions are shared and not counted
+    shared = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+              types.ClassType, types.MethodType)
+    seen  = set()
+    stack = [obj]
+    size  = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, shared): continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+class FinishedProcess:
+    # A returned process with open pipes
+    def __init__(self, retcode = 0):
+        self.retcode = retcode
+        r, w = os.pipe()
+        os.close(w)
+        self.stdout = os.fdopen(r, "rb")
+        r, w = os.pipe()
+        os.close(w)
+        self.stderr = os.fdopen(r, "rb")
+        self.stdin  = None
+
+    def poll(self):
+        return self.retcode
+
+
+def finished_job(jobid, output = 8192):
+    job = Job( "./simulate --seed %d --out data/%d.h5" % (jobid, jobid),
+               title = "simulation %d" % jobid,
+               descr = "benchmark job",
+               tags  = ["benchmark", "sweep"] )
+    job.set_id(jobid)
+    job.set_process(FinishedProcess(jobid % 2), "host%d" % (jobid % 8))
+
+    line = "step done, energy -1.2345e+02\n"
+    for k in range(output // len(line)):
+        job.feed("stdout", line)
+    job.feed("stdout", '!perc:100\n!file:"data/%d.h5"\n' % jobid)
+    job.end_stream("stdout")
+    job.returned()
+    return job
+
+
+def bench_finished_jobs(n = 1000):
+    # Bytes per finished job, kept as a Job and compacted to a JobRecord
+    jobs  = [ finished_job(jobid) for jobid in range(n) ]
+    full  = deep_sizeof(jobs)
+    records = [ job.compact() for job in jobs ]
+    del jobs
+    compact = deep_sizeof(records)
+    return { "jobs"           : n,
+             "bytes_per_job"  : full / float(n),
+             "bytes_per_record" : compact / float(n) }
+
+
+#
+# Simulated cluster
+#
+
+class SimulatedProcess:
+    # Returns retcode once the runtime has passed, has no output
+    def __init__(self, runtime, retcode):
+        self.end     = now() + runtime
+        self.retcode = retcode
+        self.stdout  = self.stderr = None
+
+    def poll(self):
+        return self.retcode if now() >= self.end else None
+
+
+class SimulatedHandler(Handler):
+    # Submits `jobs` jobs in batches of `batch` per handle phase, as single
+    # jobs or as one array per batch. Runtimes are exponentially distributed
+    # with mean `runtime` seconds, a fraction `failures` of the jobs fails.
+    # projects maps project -> number of jobs, every project submits a
+    # batch per handle phase (instead of `jobs` jobs without a project)
+
+    def __init__( self,
+                  hosts    = 100,
+                  slots    = 8,
+                  jobs     = 10000,
+                  batch    = 1000,
+                  runtime  = 0.01,
+                  failures = 0.01,
+                  arrays   = False,
+                  seed     = 0,
+                  projects = None ):
+
+        self.hosts    = [ "host%05d" % k for k in range(hosts) ]
+        self.jobslots = dict( (host, slots) for host in self.hosts )
+        self.left     = dict(projects) if projects else { None : jobs }
+        self.batch    = batch
+        self.runtime  = runtime
+        self.failures = failures
+        self.arrays   = arrays
+        self.random   = random.Random(seed)
+
+    def register_jobs(self, daemon):
+        jobs = []
+        for project in sorted(self.left):
+            n = min(self.batch, self.left[project])
+            self.left[project] -= n
+            if not n: continue
+            if self.arrays:
+                jobs.append(JobArray("./sim {0}", range(n), title = "sweep", project = project))
+            else:
+                jobs.extend( Job("./sim %d" % k, title = "sim", project = project) for k in range(n) )
+        return jobs
+
+    def check_host(self, host):
+        return True
+
+    def start_job(self, daemon, job, host):
+        runtime = self.random.expovariate(1. / self.runtime) if self.runtime else 0.
+        retcode = 1 if self.random.random() < self.failures else 0
+        job.set_process(SimulatedProcess(runtime, retcode), host)
+
+    def finalize_jobs(self, daemon, jobs):
+        return {}
+
+
+class RecordingCommunicator(Communicator):
+    # Registration and start time of every job, indexed by jobid
+
+    def __init__(self):
+        self.registered = array("d")
+        self.waits      = array("d")
+        self.project_waits = {}     # project -> waits
+        self.started    = 0
+        self.finalized  = 0
+
+    def _stamp(self, jobid, t):
+        if jobid >= len(self.registered):
+            self.registered.extend([0.] * (jobid + 1 - len(self.registered)))
+        self.registered[jobid] = t
+
+    def jobs_registered(self, daemon, jobs):
+        t = now()
+        for job in jobs:
+            if isinstance(job, JobArray):
+                for jobid in xrange(job.id + 1, job.id + len(job) + 1):
+                    self._stamp(jobid, t)
+            else:
+                self._stamp(job.id, t)
+
+    def jobs_started(self, daemon, jobs):
+        t = now()
+        for job in jobs:
+            wait = t - self.registered[job.id]
+            self.waits.append(wait)
+            self.project_waits.setdefault(job.project, array("d")).append(wait)
+        self.started += len(jobs)
+
+    def jobs_finalized(self, daemon, jobs):
+        self.finalized += len(jobs)
+
+
+def percentiles(values, points = (50, 90, 99, 100)):
+    values = sorted(values)
+    if not values: return dict( ("p%d" % p, None) for p in points )
+    return dict( ("p%d" % p, values[min(len(values) - 1, int(len(values) * p / 100.))])
+                 for p in points )
+
+
+def bench_daemon( jobs         = 10000,
+                  hosts        = 100,
+                  slots        = 8,
+                  batch        = 1000,
+                  runtime      = 0.01,
+                  failures     = 0.01,
+                  arrays       = False,
+                  communicators = 1,
+                  handle_every = 10,
+                  timeout      = 600.,
+                  projects     = None,
+                  weights      = None,
+                  quotas       = None,
+                  halflife     = 60.,
+                  sample       = 0.1 ):
+
+    # Runs the simulated cluster until all jobs are finalized (or timeout
+    # seconds passed), timing every call of Daemon.core. With projects the
+    # share of the running cores of every project is sampled every
+    # `sample` seconds
+    if projects:
+        jobs  = sum(projects.values())
+        queue = FairShareQueue(weights, quotas, halflife)
+    else:
+        queue = None
+    handler = SimulatedHandler(hosts, slots, jobs, batch, runtime, failures, arrays,
+                               projects = projects)
+    comms   = [ RecordingCommunicator() for k in range(communicators) ]
+    daemon  = Daemon(handler, comms, queue = queue)
+    recorder = comms[0]
+    timeline = []
+
+    rss0  = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ticks = array("d")
+    peak  = 0
+    start = now()
+    tick  = 0
+    done = lambda: daemon.registry.count("finished") + daemon.registry.count("failed")
+    while done() < jobs and now() - start < timeout:
+        daemon.handle  = tick % handle_every == 0
+        daemon.control = True
+        t = now()
+        daemon.core()
+        ticks.append(now() - t)
+        peak = max(peak, len(daemon.registry))
+        tick += 1
+        if projects and now() - start >= sample * len(timeline):
+            timeline.append((now() - start, running_shares(daemon)))
+    wall = now() - start
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    busy = sum(ticks)
+    result = { "jobs"            : jobs,
+               "hosts"           : hosts,
+               "slots"           : slots,
+               "batch"           : batch,
+               "runtime"         : runtime,
+               "failures"        : failures,
+               "arrays"          : arrays,
+               "communicators"   : communicators,
+               "ticks"           : len(ticks),
+               "wall"            : wall,
+               "started"         : recorder.started,
+               "finalized"       : recorder.finalized,
+               "tick_mean"       : busy / len(ticks) if ticks else None,
+               "tick"            : percentiles(ticks),
+               "starts_per_second" : recorder.started / busy if busy else None,
+               "time_to_start"   : percentiles(recorder.waits),
+               "rss_per_job"     : (rss1 - rss0) * 1024. / peak if peak else None,
+               "peak_jobs"       : peak }
+
+    if projects:
+        result["weights"]  = weights
+        result["quotas"]   = quotas
+        result["timeline"] = timeline
+        result["projects"] = dict( (project, project_summary(project, timeline, recorder))
+                                   for project in projects )
+    return result
+
+
+def running_shares(daemon):
+    # Fraction of the running cores used by every project
+    cores = {}
+    for job in daemon.registry.jobs_in("running"):
+        cores[job.project] = cores.get(job.project, 0) + job.cores
+    total = float(sum(cores.values()))
+    return dict( (project, n / total) for project, n in cores.items() ) if total else {}
+
+
+def project_summary(project, timeline, recorder):
+    # Mean share while the cluster was busy and waits of a project
+    shares = [ sample.get(project, 0.) for t, sample in timeline if sample ]
+    return { "jobs_started"  : len(recorder.project_waits.get(project, ())),
+             "share"         : sum(shares) / len(shares) if shares else None,
+             "time_to_start" : percentiles(recorder.project_waits.get(project, ())) }
+
+
+def store_result(path, name, result):
+    record = { "benchmark" : name,
+               "time"      : strftime("%Y-%m-%d %H:%M:%S"),
+               "python"    : platform.python_version(),
+               "machine"   : platform.node(),
+               "result"    : result }
+    with open(path, "a") as output:
+        output.write(json.dumps(record, sort_keys = True) + "\n")
+
+
+def flatten(result, prefix = ""):
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(path, name = None):
+    # Change of every metric between the last two results of a benchmark
+    with open(path) as results:
+        records = [ json.loads(line) for line in results if line.strip() ]
+    name = name if name else records[-1]["benchmark"]
+    records = [ record for record in records if record["benchmark"] == name ]
+    if len(records) < 2:
+        print "[jodaepy] Need two results of '%s' in %s" % (name, path)
+        return
+    old, new = flatten(records[-2]["result"]), flatten(records[-1]["result"])
+    print "[jodaepy] %s: %s -> %s" % (name, records[-2]["time"], records[-1]["time"])
+    for key in sorted(new):
+        if key not in old: continue
+        change = "%+7.1f%%" % (100. * (new[key] - old[key]) / old[key]) if old[key] else "       "
+        print "          %-28s %14.6g %14.6g %s" % (key, old[key], new[key], change)
+
+
+def report(name, result):
+    print "[jodaepy] Benchmark %s" % name
+    for key, value in sorted(flatten(result).items()):
+        print "          %-28s %14.6g" % (key, value)
+
+    timeline = result.get("timeline")
+    if timeline:
+        # About 20 samples of the shares over time
+        projects = sorted(result["projects"])
+        print "[jodaepy] Share of the running cores over time"
+        print "          %8s " % "t" + " ".join( "%10s" % project for project in projects )
+        for t, sample in timeline[::max(1, len(timeline) // 20)]:
+            print "          %8.2f " % t + " ".join( "%10.3f" % sample.get(project, 0.)
+                                                   for project in projects )
+
+
+def name_values(pairs, convert):
+    # ["big:2", ...] -> {"big" : 2, ...}
+    values = {}
+    for pair in pairs or ():
+        name, value = pair.rsplit(":", 1)
+        values[name] = convert(value)
+    return values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "jodaepy benchmarks")
+    commands = parser.add_subparsers(dest = "command")
+
+    daemon = commands.add_parser("daemon", help = "simulated cluster")
+    daemon.add_argument("--jobs",     type = int,   default = 10000)
+    daemon.add_argument("--hosts",    type = int,   default = 100)
+    daemon.add_argument("--slots",    type = int,   default = 8)
+    daemon.add_argument("--batch",    type = int,   default = 1000)
+    daemon.add_argument("--runtime",  type = float, default = 0.01)
+    daemon.add_argument("--failures", type = float, default = 0.01)
+    daemon.add_argument("--arrays",   action = "store_true")
+    daemon.add_argument("--communicators", type = int, default = 1)
+    daemon.add_argument("--handle-every",  type = int, default = 10)
+    daemon.add_argument("--timeout",  type = float, default = 600.)
+    daemon.add_argument("--project",  action = "append", metavar = "NAME:JOBS",
+                        help = "jobs of a project, scheduled by fair share (repeatable)")
+    daemon.add_argument("--weight",   action = "append", metavar = "NAME:WEIGHT")
+    daemon.add_argument("--quota",    action = "append", metavar = "NAME:CORES")
+    daemon.add_argument("--halflife", type = float, default = 60.)
+    daemon.add_argument("--sample",   type = float, default = 0.1)
+    daemon.add_argument("--output")
+
+    finished = commands.add_parser("finished-jobs", help = "memory of finished jobs")
+    finished.add_argument("--jobs", type = int, default = 1000)
+    finished.add_argument("--output")
+
+    comparison = commands.add_parser("compare", help = "compare the last two results")
+    comparison.add_argument("path")
+    comparison.add_argument("--benchmark")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.path, args.benchmark)
+        sys.exit(0)
+
+    if args.command == "daemon":
+        result = bench_daemon( args.jobs, args.hosts, args.slots, args.batch, args.runtime,
+                               args.failures, args.arrays, args.communicators,
+                               args.handle_every, args.timeout,
+                               name_values(args.project, int), name_values(args.weight, float),
+                               name_values(args.quota, int), args.halflife, args.sample )
+    else:
+        result = bench_finished_jobs(args.jobs)
+
+    report(args.command, result)
+    if args.output:
+        store_result(args.output, args.command, result)
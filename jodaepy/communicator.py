@@ -1,6 +1,14 @@
 
 import sys
-from sleekxmpp import ClientXMPP
+import threading
+
+from time import time as now
+from collections import deque
+
+try:
+    from sleekxmpp import ClientXMPP
+except ImportError:
+    ClientXMPP = None   # only needed by XMPPCommunicator
 
 
 class Communicator:
@@ -13,6 +21,7 @@ class Communicator:
     def postprocessing_failed(self, daemon, error): pass
 
     def workspace_updated(self, deamon, msg): pass
+    def scripts_updated(self, deamon, scripts): pass
 
     def jobs_registered(self, daemon, jobs): pass
     def jobs_started(self, daemon, job): pass
@@ -25,9 +34,11 @@ class Communicator:
 
     def host_unavailable(self, daemon, job): pass
 
+    def dependency_failed(self, daemon, job, error): pass
+
     def communicate(self, daemon): pass
 
-    def close(): pass
+    def close(self): pass
 
 
 
@@ -96,6 +107,9 @@ class StreamCommunicator(Communicator):
     def host_unavailable(self, daemon, job):
         self.stream.write("[jodaepy] Expected hosts %s for job %d are unavailable. Dropped this job\n" % (str(job.hosts), job.id) )
 
+    def dependency_failed(self, daemon, job, error):
+        self.stream.write("[jodaepy] Dependencies of job %d failed: %s. Dropped this job\n" % (job.id, str(error)) )
+
     def communicate(self, daemon):
         pass
 
@@ -115,13 +129,223 @@ class StreamCommunicator(Communicator):
 
 
 
+
+#
+# Asynchronous dispatch
+#
+# AsyncCommunicator runs the notifications of another communicator on its
+# own thread, so that a slow communicator doesn't stall the main loop.
+# Notifications are collected for `window` seconds and then delivered with
+# all jobs of one kind in a single call (e.g. one jobs_started for 500
+# jobs). Progress updates are merged per job and are the first to be
+# dropped if more than `maxsize` notifications are queued, other
+# notifications make the daemon wait for room.
+#
+# prepare and communicate are still called in the main loop, as answers
+# may act on the daemon.
+#
+
+class AsyncCommunicator(Communicator):
+
+    batched  = ("jobs_registered", "jobs_started", "jobs_returned", "jobs_finalized")
+
+    def __init__(self, comm, window = 1., maxsize = 10000):
+        self.comm    = comm
+        self.window  = window
+        self.maxsize = maxsize
+
+        self.cond     = threading.Condition()
+        self.ordered  = deque()     # (name, args)
+        self.batches  = {}          # name -> list of jobs
+        self.progress = {}          # jobid -> [job, perc_old, perc, outfiles_old, outfiles]
+        self.size     = 0
+        self.since    = None        # arrival of the oldest queued notification
+        self.dropped  = 0           # progress updates dropped under pressure
+
+        self.daemon = None
+        self.thread = None
+        self.quit   = False
+
+
+    def prepare(self, daemon):
+        self.daemon = daemon
+        self.comm.prepare(daemon)
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def communicate(self, daemon):
+        self.comm.communicate(daemon)
+
+    def close(self):
+        # Delivers the queued notifications before closing
+        with self.cond:
+            self.quit = True
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(self.window + 10.)
+        self.comm.close()
+
+
+    def registration_failed(self, daemon, error):        self._put("registration_failed", error)
+    def finalization_failed(self, daemon, job, error):   self._put("finalization_failed", job, error)
+    def starting_failed(self, daemon, job, error):       self._put("starting_failed", job, error)
+    def postprocessing_failed(self, daemon, error):      self._put("postprocessing_failed", error)
+    def workspace_updated(self, daemon, files):          self._put("workspace_updated", files)
+    def scripts_updated(self, daemon, scripts):          self._put("scripts_updated", scripts)
+    def postprocessing_done(self, daemon, pp):           self._put("postprocessing_done", pp)
+    def host_unavailable(self, daemon, job):             self._put("host_unavailable", job)
+    def dependency_failed(self, daemon, job, error):     self._put("dependency_failed", job, error)
+
+    def jobs_registered(self, daemon, jobs): self._put_jobs("jobs_registered", jobs)
+    def jobs_started(self, daemon, jobs):    self._put_jobs("jobs_started", jobs)
+    def jobs_returned(self, daemon, jobs):   self._put_jobs("jobs_returned", jobs)
+    def jobs_finalized(self, daemon, jobs):  self._put_jobs("jobs_finalized", jobs)
+
+
+    def job_updated(self, daemon, job, dpercs, doutfiles):
+        with self.cond:
+            update = self.progress.get(job.id)
+            if update is not None:
+                # Keep the old values of the first update, so that the
+                # communicator sees the whole change
+                update[0], update[2], update[4] = job, dpercs[1], doutfiles[1]
+            elif self.size >= self.maxsize:
+                self.dropped += 1
+                self._count_dropped(1)
+            else:
+                self.progress[job.id] = [job, dpercs[0], dpercs[1], doutfiles[0], doutfiles[1]]
+                self._added(1)
+
+
+    def _put(self, name, *args):
+        with self.cond:
+            self._wait_for_room()
+            self.ordered.append((name, args))
+            self._added(1)
+
+    def _put_jobs(self, name, jobs):
+        if not jobs: return
+        with self.cond:
+            self._wait_for_room()
+            self.batches.setdefault(name, []).extend(jobs)
+            self._added(len(jobs))
+
+    def _wait_for_room(self):
+        if self.size >= self.maxsize and self.progress:
+            self.dropped += len(self.progress)
+            self._count_dropped(len(self.progress))
+            self.size -= len(self.progress)
+            self.progress = {}
+        while self.size >= self.maxsize and self.thread and self.thread.is_alive():
+            self.cond.notify_all()
+            self.cond.wait(1.)
+
+    def _added(self, n):
+        self.size += n
+        if self.since is None:
+            self.since = now()
+            self.cond.notify_all()
+
+    def _count_dropped(self, n):
+        metrics = getattr(self.daemon, "metrics", None)
+        if metrics is not None:
+            metrics.inc("jodaepy_comm_dropped_total", n, communicator = self.comm.__class__.__name__)
+
+
+    def _run(self):
+        while True:
+            with self.cond:
+                # A full queue is delivered without waiting for the window
+                while not self.quit and self.size < self.maxsize and \
+                      (self.since is None or now() - self.since < self.window):
+                    self.cond.wait(self.window if self.since is None else
+                                   max(0.01, self.since + self.window - now()))
+                if self.since is None: return
+                calls = self._take()
+
+            for name, args in calls:
+                try:
+                    getattr(self.comm, name)(self.daemon, *args)
+                except Exception as error:
+                    print "[jodaepy] Communicator of type '%s' failed in %s: %s" % \
+                          (self.comm.__class__.__name__, name, error)
+
+    def _take(self):
+        # All queued notifications, in the order they should be delivered
+        calls = list(self.ordered)
+        for name in self.batched:
+            if name in self.batches:
+                calls.append((name, (self.batches[name],)))
+        for job, perc_old, perc, outfiles_old, outfiles in self.progress.values():
+            calls.append(("job_updated", (job, (perc_old, perc), (outfiles_old, outfiles))))
+
+        self.ordered  = deque()
+        self.batches  = {}
+        self.progress = {}
+        self.size     = 0
+        self.since    = None
+        self.cond.notify_all()
+        return calls
+
+
+
+#
+# XMPP
+#
+# Messages are not sent right away but put into an outbox per contact, from
+# which a sender thread sends them, so that the daemon never waits for the
+# network. Messages that arrive within `window` seconds are merged into one
+# (of at most `maxlen` characters), every contact gets at most `rate`
+# messages per second, with bursts of up to `burst` messages. While the
+# connection is down messages are kept, and the ones sent during the last
+# `replay` seconds before the connection dropped are sent again after
+# reconnecting, as they may have been lost.
+#
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = float(burst)
+        self.last   = now()
+
+    def _refill(self):
+        t = now()
+        self.tokens = min(self.burst, self.tokens + (t - self.last) * self.rate)
+        self.last   = t
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1.: return False
+        self.tokens -= 1.
+        return True
+
+    def delay(self):
+        # Seconds until the next token is available
+        self._refill()
+        return max(0., (1. - self.tokens) / self.rate)
+
+
+class Outbox:
+    def __init__(self, rate, burst):
+        self.messages = deque()     # (time queued, body)
+        self.sent     = deque()     # (time sent, body), for replay
+        self.bucket   = TokenBucket(rate, burst)
+        self.dropped  = 0
+
+
 class XMPPCommunicator(Communicator):
 
     def __del__(self):
-        self.disconnect()
+        if getattr(self, "xmpp", None): self.disconnect()
 
-    def __init__(self, jid, passwd, contacts, accept_from=None, greeting="XMPP communication established", verbosity = 2, answer=None):
+    def __init__(self, jid, passwd, contacts, accept_from=None, greeting="XMPP communication established", verbosity = 2, answer=None,
+                 rate = 0.5, burst = 5, window = 2., maxlen = 4000, maxqueue = 1000, replay = 10.):
         # also initialize ClientXMPP
+        if ClientXMPP is None:
+            raise ImportError("XMPPCommunicator needs sleekxmpp")
 
         self.xmpp = ClientXMPP(jid, passwd)
 
@@ -134,7 +358,23 @@ class XMPPCommunicator(Communicator):
 
         self.messages = []
 
+        self.rate     = rate
+        self.burst    = burst
+        self.window   = window
+        self.maxlen   = maxlen
+        self.maxqueue = maxqueue
+        self.replay   = replay
+
+        self.cond      = threading.Condition()
+        self.outboxes  = dict( (contact, Outbox(rate, burst)) for contact in contacts )
+        self.online    = False
+        self.greeted   = False
+        self.sender    = None
+        self.quit      = False
+
+        self.xmpp.auto_reconnect = True
         self.xmpp.add_event_handler("session_start", self._start_xmpp)
+        self.xmpp.add_event_handler("disconnected", self._lost_xmpp)
         self.xmpp.add_event_handler("message", self._buffer_message)
 
 
@@ -148,6 +388,9 @@ class XMPPCommunicator(Communicator):
 
 
     def prepare(self, daemon):
+        self.sender = threading.Thread(target = self._send_loop)
+        self.sender.daemon = True
+        self.sender.start()
         self.connect()
         self.process()
 
@@ -155,9 +398,25 @@ class XMPPCommunicator(Communicator):
         self.xmpp.send_presence()
         self.xmpp.get_roster()
 
-        print "[jodaepy] " + self.greeting
-
-        self.send_message(self.greeting)
+        with self.cond:
+            self.online = True
+            self.cond.notify_all()
+
+        if not self.greeted:
+            self.greeted = True
+            print "[jodaepy] " + self.greeting
+            self.send_message(self.greeting)
+
+    def _lost_xmpp(self, event):
+        # Messages sent shortly before may not have arrived, queue them again
+        with self.cond:
+            self.online = False
+            for outbox in self.outboxes.values():
+                t = now()
+                replay = [ body for sent, body in outbox.sent if t - sent <= self.replay ]
+                outbox.messages.extendleft( (t, body) for body in reversed(replay) )
+                outbox.sent.clear()
+        print "[jodaepy] XMPP connection lost, reconnecting"
 
     def _buffer_message(self, msg):
         if msg['type'] in ['normal', 'chat']:
@@ -167,18 +426,89 @@ class XMPPCommunicator(Communicator):
     def connect(self):
         return self.xmpp.connect()
 
-    def disconnect(self):
+    def disconnect(self, timeout = 10.):
+        # Gives the sender up to timeout seconds to empty the outboxes
+        end = now() + timeout
+        with self.cond:
+            while self.online and self.sender and self.sender.is_alive() and now() < end and \
+                  any( outbox.messages for outbox in self.outboxes.values() ):
+                self.cond.notify_all()
+                self.cond.wait(0.1)
+            self.quit = True
+            self.cond.notify_all()
         return self.xmpp.disconnect()
 
     def process(self):
         return self.xmpp.process(block=False)
 
     def send_message(self, mbody, contacts = None):
+        # Queues the message, it is sent by the sender thread
         contacts = self.contacts if not contacts else contacts
-        for contact in contacts:
-            self.xmpp.send_message( mto=contact,
-                                    mbody=mbody,
-                                    mtype='chat' )
+        t = now()
+        with self.cond:
+            for contact in contacts:
+                if contact not in self.outboxes:
+                    self.outboxes[contact] = Outbox(self.rate, self.burst)
+                outbox = self.outboxes[contact]
+                if len(outbox.messages) >= self.maxqueue:
+                    outbox.messages.popleft()
+                    outbox.dropped += 1
+                outbox.messages.append((t, mbody))
+            self.cond.notify_all()
+
+
+    def _send_loop(self):
+        while True:
+            with self.cond:
+                if self.quit: return
+                timeout = self._send_due() if self.online else None
+                self.cond.wait(timeout if timeout is not None else 1.)
+
+    def _send_due(self):
+        # Sends the merged messages of every contact whose window has
+        # passed and who has a token left. Returns the seconds until
+        # something is due next, or None
+        t     = now()
+        delay = None
+        for contact, outbox in self.outboxes.items():
+            if not outbox.messages: continue
+
+            wait = outbox.messages[0][0] + self.window - t
+            if wait <= 0:
+                wait = outbox.bucket.delay()
+                if wait <= 0 and outbox.bucket.take():
+                    body = self._merge(outbox)
+                    try:
+                        self.xmpp.send_message(mto = contact, mbody = body, mtype = 'chat')
+                    except Exception as error:
+                        # Replayed once the connection is back
+                        outbox.messages.appendleft((t, body))
+                        print "[jodaepy] Could not send XMPP message to %s: %s" % (contact, error)
+                        return 1.
+                    outbox.sent.append((t, body))
+                    while outbox.sent and t - outbox.sent[0][0] > self.replay:
+                        outbox.sent.popleft()
+                    wait = 0. if outbox.messages else None
+
+            if wait is not None:
+                delay = wait if delay is None else min(delay, wait)
+        return delay
+
+    def _merge(self, outbox):
+        # Takes queued messages up to maxlen characters, at least one
+        parts  = []
+        length = 0
+        if outbox.dropped:
+            parts.append("(%d messages dropped)" % outbox.dropped)
+            length = len(parts[0])
+            outbox.dropped = 0
+        while outbox.messages:
+            body = outbox.messages[0][1].rstrip("\n")
+            if parts and length + len(body) + 1 > self.maxlen: break
+            outbox.messages.popleft()
+            parts.append(body)
+            length += len(body) + 1
+        return "\n".join(parts)
 
 
 
@@ -251,6 +581,10 @@ class XMPPCommunicator(Communicator):
         if self.verbosity > 1:
             self.send_message("Expected hosts %s for job %d are unavailable. Dropped this job\n" % (str(job.hosts), job.id) )
 
+    def dependency_failed(self, daemon, job, error):
+        if self.verbosity > 1:
+            self.send_message("Dependencies of job %d failed: %s. Dropped this job\n" % (job.id, str(error)) )
+
 
     def job_updated(self, daemon, job, dpercs, doutfiles):
         
@@ -273,5 +607,5 @@ class XMPPCommunicator(Communicator):
         self.messages = []
 
 
-    def close():
+    def close(self):
         self.disconnect()
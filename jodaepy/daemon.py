@@ -1,26 +1,63 @@
 
+import os
+import errno
+import fcntl
+import select
+import signal
+import bisect
+
 from datetime import datetime
-from time import sleep
+from time import sleep, time as now
+
+from collections import OrderedDict
 
 from error import RegistrationError, \
                   FinalizationError, \
                   PostprocessingError, \
                   HostUnavailableError, \
                   StartingError, \
-                  PreparationError
+                  PreparationError, \
+                  DependencyError
+
+from registry import JobRegistry
+from scheduler import PendingQueue, CapacityIndex
+from hosts import HostMonitor
+from pump import OutputPump
+from store import StateStore
+from workers import WorkerPool
+from dag import DependencyGraph
+from jobarray import JobArray
+from metrics import MetricsServer
+import metrics as metrics_module
 
 #
 # The daemon
 #
 
-class Daemon:
+class Daemon(object):
+
+    # Bytes written to the wakeup pipe, see wait_events
+    wakeup_bytes = { "handle" : "h", "control" : "c", "status" : "s", "comm" : "m" }
+
     def __init__( self,
                   handler,
                   communicators,
                   control_interval = 5,
                   handle_interval  = 15,
                   comm_interval    = 1,
-                  initial_id       = 0
+                  initial_id       = 0,
+                  event_driven     = False,
+                  event_latency    = 0.1,
+                  host_ttl         = 60,
+                  probe_workers    = 8,
+                  finalize_window  = 0,
+                  statefile        = None,
+                  finalize_workers = 0,
+                  finalize_queue   = 16,
+                  queue            = None,
+                  metrics          = None,
+                  metrics_port     = None,
+                  profile_hook     = None
                 ):
 
         self.handler = handler
@@ -28,10 +65,53 @@ class Daemon:
         self.jobslots = self.handler.jobslots
         self.communicators = communicators
 
+        # Durations of the phases of core and of the handler calls, queue
+        # depths and slot utilisation. Served in the Prometheus text format
+        # on localhost:metrics_port, if given. profile_hook is called as
+        # profile_hook(name, seconds, labels) for every timing
+        self.metrics = metrics if metrics is not None else metrics_module.default
+        if profile_hook is not None:
+            self.metrics.profile = profile_hook
+        self.metrics_server = MetricsServer(self.metrics, metrics_port) if metrics_port else None
+
+        # Health of the hosts is probed in the background, scheduling
+        # decisions only read the cached state
+        check_host   = self.metrics.timed( self.handler.check_host,
+                                           "jodaepy_handler_seconds", call = "check_host" )
+        self.monitor = HostMonitor( check_host,
+                                    self.hosts,
+                                    ttl     = host_ttl,
+                                    workers = probe_workers )
+
         self.control_interval = control_interval
         self.handle_interval  = handle_interval
         self.comm_interval    = comm_interval
 
+        # In event driven mode the intervals are only upper bounds: child
+        # exits, job output and changes of the workspace wake the daemon
+        # immediately, but never more often than every event_latency seconds
+        self.event_driven  = event_driven
+        self.event_latency = event_latency
+
+        self.wakeup_r = None
+        self.wakeup_w = None
+
+        # Reads the output of running jobs as soon as it arrives
+        self.pump = OutputPump(self.wakeup)
+
+        # Returned jobs are collected for at least finalize_window seconds
+        # and then finalized in one batch by the handler
+        self.finalize_window = finalize_window
+        self.returned_since  = None
+
+        # With finalize_workers > 0, finalization and postprocessing run in
+        # a worker pool, so that slow uploads don't delay the main loop
+        if finalize_workers > 0:
+            self.workers = WorkerPool(finalize_workers, finalize_queue, self.wakeup)
+        else:
+            self.workers = None
+        self.postprocessing = False
+
         self.control_counter = 0
         self.handle_counter  = 0
         self.comm_counter    = 0
@@ -39,18 +119,62 @@ class Daemon:
         self.handle  = False
         self.control = False
         self.comm    = False
+        self.status  = False
 
+        # Registrations and state changes are journaled to the statefile,
+        # from which a restarted daemon restores its queue
+        self.store = StateStore(statefile) if statefile else None
 
-        self.pending_jobs  = []
-        self.returned_jobs = []
-        self.failed_jobs   = []
-        self.finished_jobs = []
+        self.registry = JobRegistry(self.hosts, self.store)
+        # Order in which pending jobs start, e.g. scheduler.FairShareQueue
+        self.queue    = queue if queue is not None else PendingQueue()
+
+        # Jobs waiting for other jobs to finish
+        self.graph    = DependencyGraph()
+
+        # Array jobs by id, their tasks are created one at a time
+        self.arrays    = {}
+        self.array_ids = []     # sorted
+
+        # Hosts may declare capacities (cores, memory, scratch, labels) via
+        # handler.capacities, by default they offer one core per jobslot
+        capacities = getattr(self.handler, "capacities", None) or {}
+        for host in self.hosts:
+            capacity = dict(capacities.get(host, {}))
+            capacity.setdefault("cores", self.jobslots[host])
+            capacities[host] = capacity
+        self.capacity = CapacityIndex(capacities)
 
         self.next_id = initial_id
 
-        self.running_jobs  = {} # one list for every host
+        self.describe_metrics()
+
+
+    #
+    # Read-only views on the registry
+    #
+
+    @property
+    def pending_jobs(self):  return self.queue.jobs()
+
+    @property
+    def waiting_jobs(self):  return self.registry.jobs_in("waiting")
+
+    @property
+    def returned_jobs(self): return self.registry.jobs_in("returned")
+
+    @property
+    def failed_jobs(self):   return self.registry.jobs_in("failed")
+
+    @property
+    def finished_jobs(self): return self.registry.jobs_in("finished")
+
+    @property
+    def running_jobs(self):
+        running = {}
         for host in self.hosts:
-            self.running_jobs[host] = []
+            running[host] = self.registry.running_on(host)
+        return running
 
 
     def run(self):
@@ -62,16 +186,17 @@ class Daemon:
 
         print "[jodaepy] Handler of type '%s' prepared sucessfully" % self.handler.__class__.__name__
 
+        self.monitor.start()
+        self.pump.start()
+        if self.workers: self.workers.start()
+        if self.metrics_server: self.metrics_server.start()
+
         for comm in self.communicators:
             comm.prepare(self)
             print "[jodaepy] Communicator of type '%s' prepared sucessfully" % comm.__class__.__name__
 
-        #
-        # Timed main loop
-        #
-
-        time = 0.
-        dt0 = datetime.now()
+        if self.store:
+            self.restore()
 
         self.quit = False
 
@@ -81,22 +206,47 @@ class Daemon:
         self.control = True
         self.comm    = True
 
-        while not self.quit:
+        try:
+            if self.event_driven:
+                self.run_events()
+            else:
+                self.run_timed()
+        finally:
+            self.monitor.stop()
+            self.pump.stop()
+            if self.workers: self.workers.stop()
+            if self.metrics_server: self.metrics_server.stop()
+            if self.store: self.store.close()
+            self.handler.close(self)
 
-            #
-            # Core-function
-            #
 
-            try:
+    def step(self):
+        try:
 
-                self.core()
+            self.core()
 
-            except KeyboardInterrupt as error:
-                for comm in self.communicators:
-                    comm.close()
-                raise error
+        except KeyboardInterrupt as error:
+            for comm in self.communicators:
+                comm.close()
+            raise error
+
+
+    def run_timed(self):
+
+        #
+        # Timed main loop
+        #
+
+        time = 0.
+        dt0 = datetime.now()
+
+        while not self.quit:
 
+            #
+            # Core-function
+            #
 
+            self.step()
 
 
             #
@@ -145,8 +295,145 @@ class Daemon:
             sleep(int(time) + 1 - time)
 
 
+    def run_events(self):
+
+        #
+        # Event driven main loop
+        #
+
+        self.open_wakeup()
+
+        try:
+            last = now()
+            deadlines = { "handle"  : last + self.handle_interval,
+                          "control" : last + self.control_interval,
+                          "comm"    : last + self.comm_interval }
+
+            while not self.quit:
+
+                self.step()
+                last = now()
+
+                for phase in deadlines:
+                    if getattr(self, phase):
+                        deadlines[phase] = last + getattr(self, phase + "_interval")
+
+                # Returned jobs are finalized once their window has passed
+                if self.returned_since is not None:
+                    deadlines["handle"] = min( deadlines["handle"],
+                                               self.returned_since + self.finalize_window )
+
+                self.handle  = False
+                self.control = False
+                self.comm    = False
+                self.status  = False
+
+                #
+                # Wait for an event or the next deadline
+                #
+
+                timeout = max(0., min(deadlines.values()) - now())
+                self.wait_events(timeout)
+
+                t = now()
+                for phase in deadlines:
+                    if t >= deadlines[phase]: setattr(self, phase, True)
+
+                #
+                # Let bursts of events coalesce
+                #
+
+                if t - last < self.event_latency:
+                    sleep(self.event_latency - (t - last))
+
+        finally:
+            self.close_wakeup()
+
+
+    def open_wakeup(self):
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+        # Exited children wake the control phase. Restart interrupted system
+        # calls, so that subprocesses of the handler are not disturbed
+        signal.signal(signal.SIGCHLD, lambda signum, frame: self.wakeup("control"))
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+
+    def close_wakeup(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        self.wakeup_r = None
+        self.wakeup_w = None
+
+
+    def wakeup(self, phase = "control"):
+        # Can be called by handlers and communicators to trigger a phase
+        # ("handle", "control", "status" or "comm") as soon as possible.
+        # Anything else only wakes up the main loop
+        if self.wakeup_w is None: return
+        try:
+            os.write(self.wakeup_w, self.wakeup_bytes.get(phase, "w"))
+        except OSError as error:
+            if error.errno != errno.EAGAIN: raise
+
+
+    def wait_events(self, timeout):
+
+        # Output of the jobs is signaled by the pump via the wakeup pipe,
+        # changes of the workspace by the handler's file descriptors
+        try:
+            ready, _, _ = select.select([self.wakeup_r] + self.handler.filenos(), [], [], timeout)
+        except select.error as error:
+            if error.args[0] != errno.EINTR: raise
+            ready = [self.wakeup_r]
+
+        for fd in ready:
+            if fd == self.wakeup_r:
+                try:
+                    events = os.read(self.wakeup_r, 4096)
+                except OSError as error:
+                    if error.errno != errno.EAGAIN: raise
+                    events = ""
+                if "h" in events: self.handle  = True
+                if "c" in events: self.control = True
+                if "s" in events: self.status  = True
+                if "m" in events: self.comm    = True
+
+        if self.handler.workspace_changed(self):
+            self.handle = True
+
+
     def core(self):
 
+        tick = t = now()
+
+        #
+        # Collect finalizations and postprocessing done by the workers
+        #
+
+        if self.workers:
+            for task in self.workers.done():
+                if task.tag == "finalize":
+                    jobs = task.args[1]
+                    if task.error is None:
+                        errors = task.result
+                    else:
+                        errors = dict( (job.id, FinalizationError(str(task.error))) for job in jobs )
+                    self.finish(jobs, errors)
+
+                else:
+                    self.postprocessing = False
+                    if task.error is None:
+                        self.postprocessed(task.result)
+                    else:
+                        self.postprocessed(None, PostprocessingError(str(task.error)))
+
+            t = self.timed("collect", t)
+
         #
         # Handle: Register new jobs, finish returned jobs
         #
@@ -173,62 +460,75 @@ class Daemon:
 
                 new = self.handler.register_jobs(self)
             
-                self.pending_jobs.extend(new)
-
                 for job in new: self.register(job)
-                self.pending_jobs.sort(key = lambda job: - job.priority)
 
 
                 for comm in self.communicators:
                     comm.jobs_registered(self, new)
 
             except RegistrationError as error:
+                for job in error.jobs: self.register(job)
+
                 for comm in self.communicators:
                     comm.registration_failed(self, error)
+                    comm.jobs_registered(self, error.jobs)
+
+            # New jobs are started right away, not at the next control tick
+            if self.queue:
+                self.control = True
+
+            t = self.timed("register", t)
 
 
             #
             # Finish jobs
             #
 
-            
+            returned = self.registry.jobs_in("returned")
 
-            finalized = []
-            for job in reversed(self.returned_jobs):
-                try:
-                    self.handler.finalize_job(self, job)
+            if returned and now() - self.returned_since >= self.finalize_window:
 
-                    if job.failed(): self.failed_jobs.append(job)
-                    else:            self.finished_jobs.append(job)
+                if not self.workers:
+                    with self.metrics.timer("jodaepy_handler_seconds", call = "finalize_jobs"):
+                        errors = self.handler.finalize_jobs(self, returned)
+                    self.returned_since = None
+                    self.finish(returned, errors)
 
-                    self.returned_jobs.remove(job)
-                    finalized.append(job)
+                elif not self.workers.full():
+                    # Hand the jobs to the worker pool, in batches that the
+                    # handler needs to be processed one after the other
+                    self.returned_since = None
+                    batches = OrderedDict()
+                    for job in returned:
+                        self.registry.move(job, "finalizing")
+                        batches.setdefault(self.handler.finalization_key(job), []).append(job)
 
+                    finalize = self.metrics.timed( self.handler.finalize_jobs,
+                                                   "jodaepy_handler_seconds", call = "finalize_jobs" )
+                    for key, batch in batches.items():
+                        self.workers.submit(key, "finalize", finalize, self, batch)
 
-                except FinalizationError as error:
-                    self.returned_jobs.remove(job)
-                    self.failed_jobs.append(job)
-                    for comm in self.communicators:
-                        comm.finalization_failed(self, job, error)
+            elif not self.workers:
+                self.finish([], {})
 
-
-            for comm in self.communicators:
-                comm.jobs_finalized(self, finalized)
+            t = self.timed("finalize", t)
 
 
             #
             # Postprocessing (upload result files or similar stuff)
             #
 
-            try:
-                pp = self.handler.postprocess(self)
+            if not self.workers:
+                try:
+                    self.postprocessed(self.handler.postprocess(self))
+                except PostprocessingError as error:
+                    self.postprocessed(None, error)
 
-                for comm in self.communicators:
-                    comm.postprocessing_done(self, pp)
+            elif not self.postprocessing:
+                self.postprocessing = True
+                self.workers.submit("postprocess", "postprocess", self.handler.postprocess, self)
 
-            except PostprocessingError as error:
-                for comm in self.communicators:
-                    comm.postprocessing_failed(self, job, error)
+            t = self.timed("postprocess", t)
 
 
 
@@ -243,59 +543,121 @@ class Daemon:
             #
             
             returned = []
-
-            # TODO: make this code prettier
-            for host in self.hosts:
-                _returned = [ job for job in self.running_jobs[host] if job.returned() ]
-                self.running_jobs[host] = [ job for job in self.running_jobs[host] if job not in _returned ]
-                returned.extend(_returned)
-                self.returned_jobs.extend(_returned)
+            for job in self.registry.jobs_in("running"):
+                if not job.returned(): continue
+                if self.handler.confirm_return(self, job):
+                    returned.append(job)
+                else:
+                    # Still running, followed by a new process
+                    self.pump.remove(job)
+                    self.pump.add(job)
+
+            for job in returned:
+                self.registry.move(job, "returned")
+                self.capacity.release(job.running_host, job)
+                self.queue.returned(job)
+
+            if returned and self.returned_since is None:
+                self.returned_since = now()
 
             for comm in self.communicators:
                 comm.jobs_returned(self, returned)
+
+            t = self.timed("control", t)
             
             #
             # Start new jobs
             #
 
 
-            started = []
-            for job in reversed(list(reversed(self.pending_jobs))): # need reversed to remove while iterating
+            # Only available hosts offer their free cores
+            for host in self.monitor.changed():
+                self.capacity.set_available(host, self.monitor.available(host))
+
+            # Walk the queue from the top and stop as soon as no host has
+            # enough free cores for the smallest request still queued. Jobs
+            # that fit on none of the free hosts are put back afterwards, as
+            # are the following jobs of the same shape, without looking for
+            # a host again
+            started  = []
+            deferred = []
+            unfit    = set()
+            while ( self.capacity.free_cores > 0 and self.queue and
+                    self.capacity.levels[-1] >= self.queue.min_cores() ):
+                job = self.queue.pop()
+                if job is None: break
+                shape = ( job.cores, job.memory, job.scratch, job.labels,
+                          tuple(job.hosts) if job.hosts is not None else None )
+                if shape in unfit:
+                    deferred.append(job)
+                    continue
+                host = None
                 try:
                     host = self.fitting_host(job)
                     if host:
-                        self.handler.start_job(self, job, host)
-                        self.running_jobs[host].append(job)
+                        with self.metrics.timer("jodaepy_handler_seconds", call = "start_job"):
+                            self.handler.start_job(self, job, host)
+                        self.pump.add(job)
+                        self.registry.move(job, "running")
+                        self.capacity.allocate(host, job)
+                        self.queue.started(job)
                         started.append(job)
+                        self.advance(job)
+                    else:
+                        unfit.add(shape)
+                        deferred.append(job)
 
                 except HostUnavailableError:
-                    self.pending_jobs.remove(job)
-                    self.failed_jobs.append(job)
+                    # The other tasks of an array wouldn't fit either
+                    if job.array_id is not None:
+                        self.arrays[job.array_id].drop_rest()
+                    self.registry.move(job, "failed")
                     for comm in self.communicators:
                         comm.host_unavailable(self, job)
+                    self.settle(job)
 
                 except StartingError as error:
-                    self.pending_jobs.remove(job)
-                    self.failed_jobs.append(job)
+                    # Don't start more jobs on the host until a probe
+                    # found it working again
+                    if host is not None:
+                        self.monitor.mark_down(host)
+                        self.capacity.set_available(host, False)
+                    self.registry.move(job, "failed")
                     for comm in self.communicators:
                         comm.starting_failed(self, job, error)
+                    self.advance(job)
+                    self.settle(job)
 
-
-            self.pending_jobs = [ job for job in self.pending_jobs if not job.started() ]
+            for job in deferred:
+                self.queue.push(job)
 
             for comm in self.communicators:
                 comm.jobs_started(self, started)
 
-            #
-            # Check for updatet status information
-            #
+            self.metrics.inc("jodaepy_jobs_started_total", len(started))
+            t = self.timed("start", t)
+
+        #
+        # Status: Check for updatet status information
+        #
 
-            for host in self.hosts:
-                for job in self.running_jobs[host]:
-                    percs, outfiles = job.update_status()
+        if self.control or self.status:
 
-                    for comm in self.communicators:
-                        comm.job_updated(self, job, percs, outfiles)
+            # Only jobs that received output can have a new status, unless
+            # there is no pump thread recording them
+            if self.pump.running():
+                updated = [ job for job in self.pump.updated()
+                            if self.registry.state_of(job) == "running" ]
+            else:
+                updated = self.registry.jobs_in("running")
+
+            for job in updated:
+                percs, outfiles = job.update_status()
+
+                for comm in self.communicators:
+                    comm.job_updated(self, job, percs, outfiles)
+
+            t = self.timed("status", t)
 
 
         #
@@ -306,62 +668,370 @@ class Daemon:
             for comm in self.communicators:
                 comm.communicate(self)
 
+            t = self.timed("comm", t)
+
+        if self.store:
+            self.store.commit()
+            t = self.timed("commit", t)
+
+        self.timed("tick", tick)
+
+
+    def timed(self, phase, t):
+        # Records the duration of a phase that started at t, returns the
+        # start of the next one
+        end = now()
+        self.metrics.observe("jodaepy_phase_seconds", end - t, phase = phase)
+        return end
+
+
+    def describe_metrics(self):
+        metrics = self.metrics
+        metrics.describe("jodaepy_phase_seconds", "Duration of the phases of the main loop")
+        metrics.describe("jodaepy_handler_seconds", "Duration of the calls of the handler")
+        metrics.describe("jodaepy_jobs_started_total", "Jobs started")
+
+        states = ("waiting", "pending", "running", "returned", "finalizing", "finished", "failed")
+        metrics.gauge( "jodaepy_jobs",
+                       lambda: [ ({"state" : state}, self.registry.count(state)) for state in states ],
+                       "Jobs by state" )
+        metrics.gauge( "jodaepy_queue_depth", lambda: len(self.queue),
+                       "Jobs in the pending queue" )
+        metrics.gauge( "jodaepy_free_cores", lambda: self.capacity.free_cores,
+                       "Free cores on all hosts" )
+        metrics.gauge( "jodaepy_slot_utilisation", self.slot_utilisation,
+                       "Fraction of the cores of all hosts in use" )
+        metrics.gauge( "jodaepy_finalization_lag",
+                       lambda: [ ({"kind" : kind}, value) for kind, value in self.finalization_lag().items() ],
+                       "Returned jobs not finalized yet, see Daemon.finalization_lag" )
+
+
+    def slot_utilisation(self):
+        total = sum( self.capacity.capacity[host]["cores"] for host in self.hosts )
+        return 1. - float(self.capacity.free_cores) / total if total else 0.
+
+
+    def finish(self, jobs, errors):
+        # Bookkeeping for finalized jobs, errors maps jobid -> error. Only
+        # a JobRecord is kept of every finalized job
+        finalized = []
+        for job in jobs:
+            self.pump.remove(job)
+
+            if job.id in errors:
+                self.registry.move(job, "failed")
+                for comm in self.communicators:
+                    comm.finalization_failed(self, job, errors[job.id])
+            else:
+                if job.failed(): self.registry.move(job, "failed")
+                else:            self.registry.move(job, "finished")
+
+            record = job.compact(self.registry.state_of(job))
+            self.registry.replace(job, record)
+            if job.id not in errors:
+                finalized.append(record)
+
+            self.settle(record)
+
+        for comm in self.communicators:
+            comm.jobs_finalized(self, finalized)
+
+
+    def postprocessed(self, pp, error = None):
+        if error is None:
+            for comm in self.communicators:
+                comm.postprocessing_done(self, pp)
+        else:
+            for comm in self.communicators:
+                comm.postprocessing_failed(self, error)
+
+
+    def finalization_lag(self):
+        # How far finalization is lagging behind: returned jobs not handed
+        # to the workers yet, jobs being finalized, waiting and running
+        # worker tasks and the age of the oldest task in seconds
+        lag = { "returned"   : self.registry.count("returned"),
+                "finalizing" : self.registry.count("finalizing") }
+        if self.workers:
+            lag.update(self.workers.lag())
+        return lag
+
+
+    def restore(self):
+
+        #
+        # Restore the active jobs and the id counter from the statefile
+        #
+
+        self.next_id = max(self.next_id, self.store.next_id(self.next_id))
+
+        for array in self.store.load_arrays():
+            self.add_array(array)
+
+        requeued = []
+        for state, job in self.store.load():
+
+            self.graph.index(job)
+
+            if state == "finalizing":
+                state = "returned"
+
+            if state == "running":
+                # Running jobs are adopted again if the handler can
+                # reattach to them, otherwise they are queued again
+                try:
+                    reattached = job.running_host in self.hosts and \
+                                 self.handler.reattach_job(self, job)
+                except StartingError:
+                    reattached = False
+
+                if reattached:
+                    self.registry.add(job, "running", record = False)
+                    self.capacity.allocate(job.running_host, job)
+                    self.queue.started(job)
+                    self.pump.add(job)
+                else:
+                    requeued.append(job)
+                    job.stime = None
+                    job.running_host = None
+                    self.registry.add(job, "pending")
+                    self.queue.push(job)
+
+            else:
+                self.registry.add(job, state, record = False)
+                if state == "pending":
+                    self.queue.push(job)
+
+        # Rebuild the dependency graph once all active jobs are known
+        for job in self.registry.jobs_in("waiting"):
+            try:
+                state = self.graph.add(job, self.state_of)
+            except DependencyError:
+                state = "failed"
+            if state == "ready":
+                self.registry.move(job, "pending")
+                self.queue.push(job)
+            elif state == "failed":
+                self.registry.move(job, "failed")
+
+        for array in self.arrays.values():
+            if array.state == "waiting":
+                try:
+                    state = self.graph.add(array, self.state_of)
+                except DependencyError:
+                    state = "failed"
+                if state == "ready":
+                    self.activate(array)
+                elif state == "failed":
+                    self.drop(array.id, DependencyError("Dependency failed"))
+            elif array.done():
+                self.complete(array)
+            elif not array.counts["pending"]:
+                self.advance(array)
+
+        if self.registry.count("returned") and self.returned_since is None:
+            self.returned_since = now()
+
+        self.store.commit()
+
+        print "[jodaepy] Restored %d jobs from %s" % (len(self.registry), self.store.path)
+        if requeued:
+            print "[jodaepy] Could not reattach to jobs %s, queued them again" % [job.id for job in requeued]
+
+
+    def running(self):
+        return self.registry.jobs_in("running")
+
 
     def register(self, job):
+        if isinstance(job, JobArray):
+            return self.register_array(job)
+
         job.set_id(self.next_id)
         self.next_id += 1
+        if self.store: self.store.set_next_id(self.next_id)
 
-    def free_jobslots(self, host):
-        return self.jobslots[host] - len(self.running_jobs[host])
-        
+        state = self.dependencies(job)
+
+        if state == "ready":
+            self.registry.add(job, "pending")
+            self.queue.push(job)
+        elif state == "waiting":
+            self.registry.add(job, "waiting")
+        else:
+            self.registry.add(job, "failed")
+            for comm in self.communicators:
+                comm.dependency_failed(self, job, state if state != "failed" else
+                                       DependencyError("Dependency failed before registration"))
 
-    def fitting_host(self, job):
 
-        working_hosts  = [ host for host in self.hosts if self.handler.check_host(host) ]
-        possible_hosts = working_hosts if job.hosts == None else [ host for host in working_hosts if host in job.hosts ]
+    def register_array(self, array):
+        # The array takes one id, its tasks the following len(array) ids
+        array.set_id(self.next_id)
+        self.next_id += len(array) + 1
+        if self.store: self.store.set_next_id(self.next_id)
 
-        def key(host): return self.free_jobslots(host)
+        self.add_array(array)
+        state = self.dependencies(array)
 
+        if state == "ready":
+            self.activate(array)
+        elif state == "waiting":
+            if self.store: self.store.record_array(array)
+        else:
+            self.drop(array.id, state if state != "failed" else
+                      DependencyError("Dependency failed before registration"))
+
+
+    def dependencies(self, job):
+        # Returns "ready", "waiting", "failed" or a DependencyError
+        self.graph.index(job)
         try:
-            ordered_hosts = sorted(possible_hosts, key = key)
-            if len(ordered_hosts) == 0 or self.free_jobslots(ordered_hosts[-1]) == 0:
-                return None
-            else:
-                return ordered_hosts[-1]
+            job.depends = self.graph.resolve(job)
+            return self.graph.add(job, self.state_of)
+        except DependencyError as error:
+            return error
+
+
+    def add_array(self, array):
+        self.arrays[array.id] = array
+        bisect.insort(self.array_ids, array.id)
+        self.registry.track(array)
+        self.graph.index(array)
+
+    def array_of(self, jobid):
+        # The array that jobid is a task of, or None
+        i = bisect.bisect_right(self.array_ids, jobid) - 1
+        if i < 0: return None
+        array = self.arrays[self.array_ids[i]]
+        return array if array.index_of(jobid) is not None else None
+
+    def activate(self, array):
+        array.state = "pending"
+        if self.store: self.store.record_array(array)
+        self.advance(array)
+
+    def advance(self, job):
+        # Queue the next task of an array, once the previous one left the
+        # queue. Accepts the array or one of its tasks
+        array = job if isinstance(job, JobArray) else self.arrays.get(job.array_id)
+        if array is None or array.state != "pending": return
+        task = array.next_task()
+        if task is not None:
+            self.registry.add(task, "pending")
+            self.queue.push(task)
+
+    def complete(self, array):
+        array.state = "failed" if array.failed() else "finished"
+        if self.store: self.store.record_array(array)
+        self.graph.unindex(array.id)
+        self.propagate(array.id)
+
+
+    def state_of(self, jobid):
+        job = self.registry.get(jobid)
+        if job is not None:
+            return self.registry.state_of(job)
+        if jobid in self.arrays:
+            return self.arrays[jobid].state
+        if self.store:
+            state = self.store.state_of(jobid)
+            if state is not None: return state
+        # Tasks of an array that were not created yet
+        array = self.array_of(jobid)
+        if array is not None and array.index_of(jobid) >= array.cursor:
+            return array.state
+        return None
 
-        except KeyError:
-            raise HostUnavailableError
 
-                  
-    def job(self, jobid):
-        for job in self.pending_jobs:
-            if job.id == jobid: return job
+    def settle(self, job):
+        # Release or drop the jobs waiting for a finished or failed job,
+        # and for its array once all tasks are done
+        self.graph.unindex(job.id)
+        self.propagate(job.id)
+        array = self.arrays.get(job.array_id)
+        if array is not None and array.state == "pending" and array.done():
+            self.complete(array)
+
+    def propagate(self, jobid):
+        if self.state_of(jobid) == "finished":
+            for ready in self.graph.finished(jobid):
+                self.control = True
+                if ready in self.arrays:
+                    self.activate(self.arrays[ready])
+                else:
+                    job = self.registry.get(ready)
+                    if job is None: continue    # removed meanwhile
+                    self.registry.move(job, "pending")
+                    self.queue.push(job)
+        else:
+            error = DependencyError("Job %d failed" % jobid)
+            for dropped in self.graph.failed(jobid):
+                self.drop(dropped, error)
+
+    def drop(self, jobid, error):
+        self.graph.remove(jobid)
+        if jobid in self.arrays:
+            job = self.arrays[jobid]
+            job.state = "failed"
+            job.drop_rest()
+            if self.store: self.store.record_array(job)
+        else:
+            job = self.registry.get(jobid)
+            if job is None: return      # removed meanwhile
+            self.registry.move(job, "failed")
+        for comm in self.communicators:
+            comm.dependency_failed(self, job, error)
 
-        for job in self.returned_jobs:
-            if job.id == jobid: return job
+    def free_jobslots(self, host):
+        return self.capacity.free[host]["cores"]
 
-        for job in self.failed_jobs:
-            if job.id == jobid: return job
+    def free_slots(self):
+        return self.capacity.free_cores
+        
 
-        for job in self.finished_jobs:
-            if job.id == jobid: return job
+    def fitting_host(self, job):
 
-        for host in self.hosts:
-            for job in self.running_jobs[host]:
-                if job.id == jobid: return job
+        # Jobs that can't run on any of their hosts, not even on an empty
+        # one, would wait forever
+        if not self.capacity.could_fit(job, job.hosts):
+            raise HostUnavailableError
 
-        return None
+        def usable(host):
+            return (job.hosts is None or host in job.hosts) and self.monitor.available(host)
+
+        return self.capacity.best_fit(job, usable)
+
+                  
+    def job(self, jobid):
+        # Returns a Job, or the JobArray for the id of an array
+        job = self.registry.get(jobid) or self.arrays.get(jobid)
+        if job is None:
+            # Tasks of an array that were not created yet
+            array = self.array_of(jobid)
+            if array is not None and array.index_of(jobid) >= array.cursor:
+                job = array.task(array.index_of(jobid))
+        if job is None and self.store:
+            # historical jobs are only kept in the statefile
+            job = self.store.load_job(jobid)
+        return job
 
 
     def remove_job(self, job):
-        try: self.pending_jobs.remove(job)
-        except: pass
-        try: self.returned_jobs.remove(job)
-        except: pass
-        try: self.failed_jobs.remove(job)
-        except: pass
-        try: self.finished_jobs.remove(job)
-        except: pass
-        for host in self.hosts:
-            try: self.running_jobs[host].remove(job)
-            except: pass
+        state = self.registry.state_of(job)
+        if state == "running":
+            self.capacity.release(job.running_host, job)
+            self.queue.returned(job)
+        # Returned jobs released their capacity already, but both may
+        # still have pipes in the pump
+        if state in ("running", "returned"):
+            self.pump.remove(job)
+
+        self.queue.remove(job)
+        self.registry.remove(job)
+        self.graph.remove(job.id)
+        array = self.arrays.get(job.array_id)
+        if array is not None:
+            array.counts["dropped"] += 1
+            self.advance(job)
+        self.settle(job)
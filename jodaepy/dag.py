@@ -0,0 +1,107 @@
+
+from error import DependencyError
+
+
+#
+# Dependencies between jobs
+#
+# A job can be declared to run after other jobs, given by id, by title or
+# tag (all active jobs with that title or tag, i.e. jobs of the same
+# submission and jobs that are not finalized yet) or by the Job object
+# returned by JOB(...) in a jobfile. The graph keeps, for every
+# waiting job, the number of dependencies that are not finished yet and,
+# for every job, the list of jobs waiting for it. A finished job therefore
+# releases its dependents without any search, a failed job fails all of
+# its (transitive) dependents.
+#
+
+class DependencyGraph:
+
+    def __init__(self):
+        self.waiting    = {}    # jobid -> number of unfinished dependencies
+        self.dependents = {}    # jobid -> list of waiting jobids
+
+        self.titles  = {}       # title -> set of jobids of active jobs
+        self.tags    = {}       # tag -> set of jobids of active jobs
+        self.indexed = {}       # jobid -> (title, tags)
+
+
+    def index(self, job):
+        if job.id in self.indexed: return
+        self.indexed[job.id] = (job.title, tuple(job.tags))
+        if job.title:
+            self.titles.setdefault(job.title, set()).add(job.id)
+        for tag in job.tags:
+            self.tags.setdefault(tag, set()).add(job.id)
+
+    def unindex(self, jobid):
+        # Once a job is done, its title and tags don't refer to it anymore
+        title, tags = self.indexed.pop(jobid, (None, ()))
+        for key, index in [ (title, self.titles) ] + [ (tag, self.tags) for tag in tags ]:
+            if key in index:
+                index[key].discard(jobid)
+                if not index[key]: del index[key]
+
+    def resolve(self, job):
+        # Translate job.after into a list of jobids
+        depends = []
+        for dep in job.after:
+            if isinstance(dep, (int, long)):
+                depends.append(dep)
+            elif isinstance(dep, basestring):
+                ids = self.titles.get(dep, set()) | self.tags.get(dep, set())
+                if not ids:
+                    raise DependencyError("No job with title or tag '%s'" % dep)
+                depends.extend(ids)
+            else:
+                depends.append(dep.id)
+        return sorted(set( jobid for jobid in depends if jobid != job.id ))
+
+
+    def add(self, job, state_of):
+        # state_of(jobid) gives the state of a job (None if unknown).
+        # Returns "ready", "waiting" or "failed"
+        count = 0
+        for jobid in job.depends:
+            state = state_of(jobid)
+            if state == "finished":
+                continue
+            if state is None:
+                raise DependencyError("Unknown job %d" % jobid)
+            if state == "failed":
+                return "failed"
+            self.dependents.setdefault(jobid, []).append(job.id)
+            count += 1
+
+        if count == 0: return "ready"
+        self.waiting[job.id] = count
+        return "waiting"
+
+
+    def remove(self, jobid):
+        # A removed job doesn't wait anymore, its dependencies skip it
+        self.waiting.pop(jobid, None)
+        self.unindex(jobid)
+
+
+    def finished(self, jobid):
+        # Returns the jobids that became ready
+        ready = []
+        for dependent in self.dependents.pop(jobid, []):
+            if dependent not in self.waiting: continue
+            self.waiting[dependent] -= 1
+            if self.waiting[dependent] == 0:
+                del self.waiting[dependent]
+                ready.append(dependent)
+        return ready
+
+    def failed(self, jobid):
+        # Returns all jobids that can't run anymore
+        failed = []
+        stack = [jobid]
+        while stack:
+            for dependent in self.dependents.pop(stack.pop(), []):
+                if self.waiting.pop(dependent, None) is not None:
+                    failed.append(dependent)
+                    stack.append(dependent)
+        return failed
@@ -1,6 +1,12 @@
 
 
-class RegistrationError(Exception): pass
+class RegistrationError(Exception):
+    # Carries the jobs that could still be registered
+    def __init__(self, msg, jobs = None):
+        Exception.__init__(self, msg)
+        self.jobs = jobs if jobs else []
+
+class JobfileError(Exception): pass
 
 class FinalizationError(Exception): pass
 
@@ -12,4 +18,6 @@ class StartingError(Exception): pass
 
 class PreparationError(Exception): pass
 
+class DependencyError(Exception): pass
+
 class GitExecError(Exception): pass
@@ -1,15 +1,24 @@
 
+import os
+import signal
+import resource
 from os import path, makedirs
 from glob import glob
+from multiprocessing import cpu_count
+from collections import OrderedDict
 import shutil
+import tempfile
+import pipes
 
 from time import sleep
 
 from subprocess import Popen, PIPE
 
-from job import Job
+from jobfile import JobfileLoader, extensions as jobfile_extensions
 
 import util
+from ssh import SSHConnections
+import watch
 
 from error import RegistrationError, \
                   FinalizationError, \
@@ -30,13 +39,21 @@ class Handler:
     def update_workspace(self, daemon):
         pass
 
+    def workspace_changed(self, daemon):
+        return False
+
+    def filenos(self):
+        # The event driven daemon calls workspace_changed as soon as one of
+        # these file descriptors becomes readable
+        return []
+
     def update_scripts( self, daemon ):
         pass
 
     def register_jobs(self, daemon):
         pass
 
-    def check_host(self, daemon, host):
+    def check_host(self, host):
         pass
 
     def start_job(self, daemon, job, host):
@@ -45,12 +62,42 @@ class Handler:
     def kill_job(self, daemon, job, host):
         pass
 
+    def reattach_job(self, daemon, job):
+        # Called on restart for jobs that were running. Return True if the
+        # job could be adopted again (with a new process)
+        return False
+
+    def confirm_return(self, daemon, job):
+        # Called for every job whose process exited. Return False if the job
+        # is in fact still running and was given a new process to follow it
+        return True
+
     def finalize_job(self, daemon, job):
         pass
 
+    def finalization_key(self, job):
+        # Jobs with the same key are finalized one after the other
+        return None
+
+    def finalize_jobs(self, daemon, jobs):
+        # Finalize several returned jobs at once. Returns a dictionary
+        # jobid -> FinalizationError for the jobs that failed
+        errors = {}
+        for job in jobs:
+            try:
+                with daemon.metrics.timer("jodaepy_handler_seconds", call = "finalize_job"):
+                    self.finalize_job(daemon, job)
+            except FinalizationError as error:
+                errors[job.id] = error
+        return errors
+
     def postprocess(self, daemon):
         pass
 
+    def close(self, daemon):
+        # Called when the daemon stops
+        pass
+
 
 
 
@@ -59,7 +106,16 @@ class Handler:
 
 
 
-class SSHGitHandler(Handler):
+#
+# Handlers that take jobfiles from a local jobdir
+#
+# Jobfiles are loaded from the jobdir and moved to the jobarchive (or the
+# quarantine if they are broken), joblogs are written to the joblogdir.
+# Subclasses decide where jobs run and may record the moves and results,
+# see archive_jobfiles and finalize_job.
+#
+
+class DirectoryHandler(Handler):
 
     def prepare(self, daemon):
         if not path.isdir(self.jobdir):     
@@ -76,6 +132,21 @@ class SSHGitHandler(Handler):
             except OSError:
                 raise PreparationError("Jobarchive '%s' not found" % self.jobarchive)
 
+        if not path.isdir(self.jobquarantine):
+            try:
+                makedirs(self.jobquarantine)
+                print "[jodaepy] Handler: Created job quarantine %s" % self.jobquarantine
+            except OSError:
+                raise PreparationError("Job quarantine '%s' not found" % self.jobquarantine)
+
+        if not self.spooldir:
+            self.spooldir = tempfile.mkdtemp(prefix = "jodaepy-spool-")
+        elif not path.isdir(self.spooldir):
+            try:
+                makedirs(self.spooldir)
+            except OSError:
+                raise PreparationError("Spool directory '%s' not found" % self.spooldir)
+
         if not path.isdir(self.joblogdir):  
             try:
                 makedirs(self.joblogdir)
@@ -83,6 +154,21 @@ class SSHGitHandler(Handler):
             except OSError:
                 raise PreparationError("Joblog directory '%s' not found" % self.joblogdir)
 
+        # New jobfiles and scripts are reported by a watcher, the
+        # directories are only scanned once at the start
+        scriptdir = self.scriptdirs[self.hosts[0]]
+        self.watcher = watch.watcher()
+        try:
+            self.watcher.watch(self.jobdir, "jobs")
+            if path.isdir(scriptdir):
+                self.watcher.watch(scriptdir, "scripts")
+            else:
+                self.lost.add("scripts")
+        except OSError as error:
+            raise PreparationError("Could not watch directories: %s" % error)
+        self.rescan_jobs    = True
+        self.rescan_scripts = True
+
         return True
 
 
@@ -93,7 +179,12 @@ class SSHGitHandler(Handler):
                   joblogdir,
                   rundirs,
                   scriptdirs,
-                  jobslots
+                  jobslots,
+                  capacities      = None,
+                  jobquarantine   = None,
+                  spooldir        = None,
+                  jobfile_timeout = 10.,
+                  jobfile_modules = ()
                 ):
         
         self.hosts  = [hosts] if type(hosts) == str else hosts
@@ -101,6 +192,12 @@ class SSHGitHandler(Handler):
         self.jobarchive = jobarchive
         self.joblogdir = joblogdir
 
+        # Jobfiles that can't be executed end up here
+        self.jobquarantine = jobquarantine if jobquarantine else path.join(jobarchive, "failed")
+
+        # Output of running jobs is spooled here, outside of the git trees
+        self.spooldir = spooldir
+
 
         if type(rundirs) == str:
             self.rundirs = {}
@@ -125,27 +222,307 @@ class SSHGitHandler(Handler):
         else:
             self.jobslots = jobslots
 
+        # Optional host -> {"cores", "memory", "scratch", "labels"}, without
+        # it every jobslot is one core
+        self.capacities = capacities
+
+        self.watcher        = None
+        self.lost           = set()     # keys of directories not watched
+        self.new_jobfiles   = set()
+        self.scripts        = set()
+        self.new_scripts    = []
+        self.rescan_jobs    = True
+        self.rescan_scripts = True
+        self.jobfiles = None
+
+        # Jobfiles are loaded in a child process, see jobfile.JobfileLoader
+        self.loader = JobfileLoader(jobfile_timeout, modules = jobfile_modules)
+
+
+    def update_workspace( self, daemon ):
+        # register_jobs works on the files found here
+        self.collect()
+        if self.rescan_jobs or self.watcher is None or "jobs" in self.lost:
+            self.rescan_jobs = False
+            self.new_jobfiles.clear()
+            self.jobfiles = self.find_jobfiles()
+        else:
+            self.jobfiles = sorted( jobfile for jobfile in self.new_jobfiles
+                                    if path.isfile(path.join(self.jobdir, jobfile)) )
+            self.new_jobfiles.clear()
+
+        return self.jobfiles
+
+
+    def find_jobfiles( self ):
+        return sorted( path.basename(s) for ext in jobfile_extensions
+                                        for s in glob(path.join(self.jobdir, "*" + ext)) )
+
+
+    def workspace_changed( self, daemon ):
+        # Cheap check used by the event driven daemon between handle ticks
+        return self.collect()
+
+    def filenos( self ):
+        fileno = self.watcher.fileno() if self.watcher else None
+        return [fileno] if fileno is not None else []
+
+
+    def collect( self ):
+        # Drain the watcher, returns whether jobfiles or scripts changed
+        if self.watcher is None: return False
+        changed = self.rewatch()
+        for key, name, present in self.watcher.changes():
+            if name is None and not present:
+                # The directory was removed or moved away
+                self.lost.add(key)
+
+            if key == "jobs":
+                if name is None:
+                    self.rescan_jobs = True
+                elif not name.endswith(jobfile_extensions):
+                    continue
+                elif present:
+                    self.new_jobfiles.add(name)
+                else:
+                    self.new_jobfiles.discard(name)
+
+            elif name is None:
+                self.rescan_scripts = True
+            elif present:
+                if name not in self.scripts:
+                    self.scripts.add(name)
+                    self.new_scripts.append(name)
+            else:
+                self.scripts.discard(name)
+            changed = True
+        return changed
+
+    def rewatch( self ):
+        # Directories that were removed are watched again once they exist
+        # again, until then they are scanned on every handle tick
+        changed = False
+        for key in list(self.lost):
+            directory = self.jobdir if key == "jobs" else self.scriptdirs[self.hosts[0]]
+            if not path.isdir(directory): continue
+            try:
+                self.watcher.watch(directory, key)
+            except OSError:
+                continue
+            self.lost.discard(key)
+            if key == "jobs": self.rescan_jobs    = True
+            else:             self.rescan_scripts = True
+            changed = True
+        return changed
+
+
+    def update_scripts( self, daemon ):
+        # Returns the scripts that are new since the last call, all of them
+        # on the first call
+        self.collect()
+        if self.rescan_scripts or self.watcher is None or "scripts" in self.lost:
+            self.rescan_scripts = False
+            sdir = self.scriptdirs[self.hosts[0]]
+            scripts = [ path.basename(s) for s in glob(path.join(sdir, "*")) ]
+            new = scripts if not self.scripts else [ s for s in scripts if s not in self.scripts ]
+            self.scripts = set(scripts)
+        else:
+            new = [ s for s in self.new_scripts if s in self.scripts ]
+        self.new_scripts = []
+        return new
+
 
-        self.scripts_old = None
+
+    def close( self, daemon ):
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+
+    def register_jobs( self, daemon ):
+        jobfiles = self.jobfiles if self.jobfiles is not None else self.find_jobfiles()
+        self.jobfiles = None
+
+        new_jobs = []
+        registered  = []
+        quarantined = []
+        errors = []
+
+        # Load every jobfile on its own, only broken files are quarantined
+        for jobfile in jobfiles:
+            jobpath = path.join(self.jobdir, jobfile)
+
+            try:
+                jobs = self.loader.load(jobpath)
+            except Exception as error:
+                util.move_to_dir(jobpath, self.jobquarantine)
+                quarantined.append(jobfile)
+                errors.append( "Error executing jobfile %s. " % jobfile +\
+                               "Moved it to %s. " % self.jobquarantine +\
+                               "Original error message:\n" + str(error) )
+                continue
+
+            util.move_to_dir(jobpath, self.jobarchive)
+            registered.append(jobfile)
+            new_jobs.extend(jobs)
+
+        # Record the moves, e.g. in version control
+        if jobfiles:
+            errors.extend(self.archive_jobfiles(jobfiles, registered, quarantined))
+
+        if errors:
+            raise RegistrationError("\n".join(errors), jobs = new_jobs)
+
+        return new_jobs
+
+    def archive_jobfiles( self, jobfiles, registered, quarantined ):
+        # Returns a list of error messages
+        return []
+
+
+    def finalize_job( self, daemon, job ):
+        job.write_log(self.joblogdir)
+
+
+
+
+class SSHGitHandler(DirectoryHandler):
+
+    def __init__( self,
+                  hosts,
+                  jobdir,
+                  jobarchive,
+                  joblogdir,
+                  rundirs,
+                  scriptdirs,
+                  jobslots,
+                  capacities     = None,
+                  jobquarantine  = None,
+                  spooldir       = None,
+                  ssh_multiplex  = True,
+                  ssh_persist    = 600,
+                  ssh_controldir = None,
+                  detach         = False,
+                  remote_jobdir  = "$HOME/.jodaepy/jobs",
+                  jobfile_timeout = 10.,
+                  jobfile_modules = ()
+                ):
+
+        DirectoryHandler.__init__( self, hosts, jobdir, jobarchive, joblogdir, rundirs,
+                                   scriptdirs, jobslots, capacities, jobquarantine, spooldir,
+                                   jobfile_timeout, jobfile_modules )
+
+        # Launches and probes share one master connection per host
+        if ssh_multiplex:
+            self.ssh = SSHConnections(ssh_controldir, persist = ssh_persist)
+        else:
+            self.ssh = None
+
+        # Detached jobs keep running on the host if the daemon stops, their
+        # pid, output and exit code are kept in remote_jobdir/<jobid>
+        self.detach = detach
+        self.remote_jobdir = remote_jobdir
+
+
+    def close(self, daemon):
+        DirectoryHandler.close(self, daemon)
+        if self.ssh:
+            self.ssh.close_all()
+
+
+    def ssh_command(self, host, rcmd = None):
+        if self.ssh:
+            return self.ssh.command(host, rcmd)
+        cmd = ["ssh", "-o", "BatchMode=yes", host]
+        if rcmd: cmd.append(rcmd)
+        return cmd
 
 
     def finalize_job(self, daemon, job):
        job.write_log(self.joblogdir)
-       # commit the outfiles of this job
-       try:
-           util.git_add('.', self.joblogdir)
-           if job.outfiles:
-               util.git_add(job.outfiles, self.rundirs[job.running_host])
-           util.git_commit(self.rundirs[job.running_host], "new result files %s" %
-                                                      job.outfiles )
-           util.git_pull(self.rundirs[job.running_host])
-           util.git_push(self.rundirs[job.running_host])
-       except GitExecError as error:
-           raise FinalizationError(str(error))
-        
+       rundir = self.rundirs[job.running_host]
+       # commit the joblog and the outfiles of this job
+       with util.repo_lock(rundir):
+           try:
+               util.git_add(["%010d.jlog" % job.id], self.joblogdir)
+               if job.outfiles:
+                   util.git_add(job.outfiles, rundir)
+               # Already committed, e.g. by a batch that failed later
+               if util.git_staged(rundir):
+                   util.git_commit(rundir, "new result files %s" % job.outfiles)
+           except GitExecError as error:
+               # Don't leave anything staged for the next job
+               try:
+                   util.git_reset(rundir)
+               except GitExecError:
+                   pass
+               raise FinalizationError(str(error))
+
+           try:
+               util.git_pull(rundir)
+               util.git_push(rundir)
+           except GitExecError as error:
+               raise FinalizationError(str(error))
+
+       if self.detach:
+           self.cleanup_remote([job])
+
+
+    def finalization_key(self, job):
+        return self.rundirs[job.running_host]
+
+    def finalize_jobs(self, daemon, jobs):
+        # Publish the joblogs and outfiles of all jobs sharing a rundir with
+        # a single commit, pull and push
+        batches = OrderedDict()
+        for job in jobs:
+            batches.setdefault(self.rundirs[job.running_host], []).append(job)
+
+        errors = {}
+        for rundir, batch in batches.items():
+            errors.update(self.finalize_batch(daemon, rundir, batch))
+        return errors
+
+
+    def finalize_batch(self, daemon, rundir, jobs):
+        outfiles = []
+        for job in jobs:
+            job.write_log(self.joblogdir)
+            outfiles.extend(job.outfiles)
+
+        with util.repo_lock(rundir):
+            try:
+                util.git_add('.', self.joblogdir)
+                if outfiles:
+                    util.git_add(outfiles, rundir)
+                util.git_commit(rundir, "new result files of jobs %s: %s" %
+                                        ([job.id for job in jobs], outfiles) )
+            except GitExecError:
+                # Some job of the batch is broken, so that it can't block the
+                # others, fall back to one commit for every job, starting
+                # from an empty index
+                try:
+                    util.git_reset(rundir)
+                except GitExecError as error:
+                    return dict( (job.id, FinalizationError(str(error))) for job in jobs )
+                return Handler.finalize_jobs(self, daemon, jobs)
+
+            try:
+                util.git_pull(rundir)
+                util.git_push(rundir)
+            except GitExecError as error:
+                return dict( (job.id, FinalizationError(str(error))) for job in jobs )
+
+        if self.detach:
+            self.cleanup_remote(jobs)
+
+        return {}
+
 
     def check_host(self, host):
-        cmd = ["ssh", "-o", "BatchMode=yes", host, "true"]
+        if self.ssh and not self.ssh.ensure(host):
+            return False
+        cmd = self.ssh_command(host, "true")
         process = Popen(cmd)
         process.communicate()
         return process.returncode == 0
@@ -153,93 +530,301 @@ class SSHGitHandler(Handler):
 
     def start_job(self, daemon, job, host):
 
-        rcmd = ["ssh", "-o", "BatchMode=yes", host]
-        rcmd.append("PATH=%s:$PATH; cd %s; %s" % (self.scriptdirs[host], self.rundirs[host], job.cmd))
+        rcmd = "PATH=%s:$PATH; cd %s; %s" % (self.scriptdirs[host], self.rundirs[host], job.cmd)
+        if self.detach:
+            rcmd = self.launch_script(job, rcmd) + self.watch_script(job)
+
         try:
-            process = Popen(rcmd, stdout=PIPE, stderr=PIPE)
-            job.set_process(process, host)
+            process = Popen(self.ssh_command(host, rcmd), stdout=PIPE, stderr=PIPE)
+            job.set_process(process, host, self.spooldir)
         except OSError as error:
             raise StartingError(str(error))
 
     def kill_job(self, daemon, job, host):
+        if self.detach:
+            kill = Popen(self.ssh_command(host, "kill -- -$(cat %s/pid)" % self.remote_dir(job)))
+            kill.communicate()
         job.process.kill()
         sleep(0.1)
         return job.returned()
 
 
+    def reattach_job(self, daemon, job):
+        # Follow the output of a detached job again, the watcher exits with
+        # the exit code of the job (255 if the job is unknown on the host)
+        if not self.detach: return False
+
+        host  = job.running_host
+        stime = job.stime
+        try:
+            process = Popen(self.ssh_command(host, self.watch_script(job)), stdout=PIPE, stderr=PIPE)
+            job.set_process(process, host, self.spooldir)
+        except OSError as error:
+            raise StartingError(str(error))
+        job.stime = stime
+        return True
+
+    def confirm_return(self, daemon, job):
+        # The watcher of a detached job also exits with 255 if the connection
+        # dropped, the job only returned if its exit code was written (or it
+        # is gone without one). Otherwise it is followed by a new watcher, so
+        # that it is neither finalized nor cleaned up while it runs
+        if not self.detach or job.retcode != 255: return True
+
+        if self.remote_state(job) in ("returned", "lost"): return True
+
+        job.retcode = job.ftime = job.noerr = None
+        try:
+            self.reattach_job(daemon, job)
+        except StartingError:
+            pass    # the old process is polled again
+        return False
+
+
+    #
+    # Remote side of detached jobs
+    #
+
+    def remote_dir(self, job):
+        return "%s/%010d" % (self.remote_jobdir, job.id)
+
+    def launch_script(self, job, rcmd):
+        # Start the job in its own session, immune to hangups, and record
+        # its pid. The exit code is written atomically when it is done
+        run = '( %s ); echo $? > "$JD/ret.tmp"; mv "$JD/ret.tmp" "$JD/ret"' % rcmd
+        return 'export JD="%s"; rm -rf "$JD"; mkdir -p "$JD" || exit 255; ' % self.remote_dir(job) + \
+               'setsid nohup sh -c %s > "$JD/out" 2> "$JD/err" < /dev/null & ' % pipes.quote(run) + \
+               'echo $! > "$JD/pid"; '
+
+    def watch_script(self, job):
+        # Mirror stdout and stderr of the job until it exits. Exits with 255
+        # if there is no exit code, as ssh does if the connection dropped
+        return 'JD="%s"; PID=$(cat "$JD/pid") || exit 255; ' % self.remote_dir(job) + \
+               'tail -c +1 -s 0.5 --pid=$PID -f "$JD/err" >&2 & ' + \
+               'tail -c +1 -s 0.5 --pid=$PID -f "$JD/out"; wait; ' + \
+               'exit $(cat "$JD/ret" 2>/dev/null || echo 255)'
+
+    def remote_state(self, job):
+        # "returned", "running" or "lost" (neither an exit code nor a running
+        # process), None if the host can't be reached
+        script = 'JD="%s"; if [ -f "$JD/ret" ]; then echo returned; ' % self.remote_dir(job) + \
+                 'elif kill -0 $(cat "$JD/pid" 2>/dev/null) 2>/dev/null; then echo running; ' + \
+                 'else echo lost; fi'
+        try:
+            process = Popen(self.ssh_command(job.running_host, script), stdout=PIPE, stderr=PIPE)
+            out, err = process.communicate()
+        except OSError:
+            return None
+        state = out.strip()
+        return state if process.returncode == 0 and state in ("returned", "running", "lost") else None
+
+    def cleanup_remote(self, jobs):
+        hosts = OrderedDict()
+        for job in jobs:
+            hosts.setdefault(job.running_host, []).append('"%s"' % self.remote_dir(job))
+        for host, dirs in hosts.items():
+            process = Popen(self.ssh_command(host, "rm -rf " + " ".join(dirs)))
+            process.communicate()
+
 
     def update_workspace( self, daemon ):
         try:
-            util.git_pull(self.jobdir)
+            if util.git_remote_changed(self.jobdir):
+                util.git_pull(self.jobdir)
         except GitExecError as error:
             raise RegistrationError("Could not update workspace: " + str(error))
 
-        jobfiles = [ path.basename(s) for s in glob(path.join(self.jobdir, "*.job")) ]
+        return DirectoryHandler.update_workspace(self, daemon)
 
-        return jobfiles
 
+    def archive_jobfiles( self, jobfiles, registered, quarantined ):
+        # Commit all moves in one transaction
+        errors = []
+        with util.repo_lock(self.jobarchive):
+            try:
+                if registered:
+                    util.git_add(registered, self.jobarchive)
+                if quarantined:
+                    util.git_add(quarantined, self.jobquarantine)
+                util.git_add(jobfiles, self.jobdir, "-u")
+                util.git_commit(self.jobarchive, "registered jobfiles %s" % registered +
+                                (", quarantined %s" % quarantined if quarantined else "") )
+                util.git_pull(self.jobarchive)
+                util.git_push(self.jobarchive)
 
-    def update_scripts( self, daemon ):
-        # broken for more general situations
-        sdir = self.scriptdirs[self.hosts[0]]
-        scripts = [ path.basename(s) for s in glob(path.join(sdir, "*")) ]
-        if self.scripts_old: 
-            dscripts = [ s for s in scripts if s not in self.scripts_old ]
-            self.scripts_old = scripts
-            return dscripts
-        else:
-            self.scripts_old = scripts
-            return scripts
+            except GitExecError as error:
+                errors.append(str(error))
+        return errors
 
 
 
-    def register_jobs( self, daemon ):
-        # Make a git pull to obtain new job files
-        jobfiles = [ path.basename(j) for j in glob(path.join(self.jobdir, "*.job")) ]
 
-        new_jobs = []
-        def JOB(*args, **kwargs): new_jobs.append(Job(*args, **kwargs))
+#
+# Running jobs on the local machine
+#
+# Jobs are subprocesses of the daemon, in a process group of their own, no
+# ssh and no git is involved. The only host is `host` with `jobslots` cores
+# (all cpus by default). With pin = True every job is bound to as many free
+# cpus as it requested cores, a memory request (in MB) limits its address
+# space. If a (delegated, v2) cgroup directory is given, every job runs in
+# a cgroup of its own below it, with cpu.max and memory.max set from its
+# request.
+#
 
-        # Try to load the jobfiles
-        for jobfile in jobfiles:
-            jobpath = path.join(self.jobdir, jobfile)
-            try:
-                execfile(jobpath)
-            except Exception as error:
-                util.move_to_dir(jobpath, self.jobarchive)
-                msg = "Error executing jobfile %s. " % jobfile +\
-                      "Moved it to job archive %s. " % self.jobarchive +\
-                      "Original error message:\n" + str(error)
-                try:
-                    util.git_add(jobfiles, self.jobarchive)
-                    util.git_add(jobfiles, self.jobdir, "-u")
-                    util.git_commit(self.jobarchive, "registered jobs %s" % 
-                                                [job.id for job in new_jobs] )
-                    #print "git commit"
-                    util.git_pull(self.jobarchive)
-                    util.git_push(self.jobarchive)
-                except GitExecError as error:
-                    raise RegistrationError(msg + "\n" + str(error))
-                raise RegistrationError(msg)
-        
+class LocalHandler(DirectoryHandler):
 
-        # So it worked for every file. Move them to archive and push
-        for jobfile in jobfiles:
-            jobpath = path.join(self.jobdir, jobfile)
-            util.move_to_dir(jobpath, self.jobarchive)
+    memory_unit = 2**20
 
-        if jobfiles:
-            try:
-                util.git_add(jobfiles, self.jobarchive)
-                util.git_add(jobfiles, self.jobdir, "-u")
-                util.git_commit(self.jobarchive, "registered jobs %s" % 
-                                            [job.id for job in new_jobs] )
-                util.git_pull(self.jobarchive)
-                util.git_push(self.jobarchive)
+    def __init__( self,
+                  jobdir,
+                  jobarchive,
+                  joblogdir,
+                  rundir,
+                  scriptdir,
+                  jobslots        = None,
+                  host            = "localhost",
+                  capacities      = None,
+                  jobquarantine   = None,
+                  spooldir        = None,
+                  pin             = True,
+                  cgroup          = None,
+                  jobfile_timeout = 10.,
+                  jobfile_modules = ()
+                ):
 
-            except GitExecError as error:
-                raise RegistrationError(str(error))
+        DirectoryHandler.__init__( self, [host], jobdir, jobarchive, joblogdir, rundir,
+                                   scriptdir, jobslots if jobslots else cpu_count(),
+                                   capacities, jobquarantine, spooldir,
+                                   jobfile_timeout, jobfile_modules )
 
-        return new_jobs
+        self.host   = host
+        self.pin    = pin
+        self.cgroup = cgroup
+
+        self.free_cpus = range(cpu_count())
+        self.pinned    = {}     # jobid -> (job, cpus, cgroup directory)
+
+
+    def prepare(self, daemon):
+        DirectoryHandler.prepare(self, daemon)
+
+        if not path.isdir(self.rundirs[self.host]):
+            raise PreparationError("Rundir '%s' not found" % self.rundirs[self.host])
+
+        if self.cgroup and not os.access(path.join(self.cgroup, "cgroup.procs"), os.W_OK):
+            raise PreparationError("Cgroup '%s' is not writable" % self.cgroup)
+
+        return True
+
+
+    def check_host(self, host):
+        return host == self.host
+
+
+    def start_job(self, daemon, job, host):
+        self.reclaim()
+
+        cpus = self.free_cpus[:job.cores] if self.pin else []
+        del self.free_cpus[:len(cpus)]
+
+        env = dict(os.environ)
+        env["PATH"] = "%s:%s" % (self.scriptdirs[host], env.get("PATH", ""))
+        env["JODAEPY_JOB"] = str(job.id)   # identifies the process, see owns
+
+        cgroup = None
+        try:
+            if self.cgroup:
+                cgroup = self.make_cgroup(job)
+            process = Popen( job.cmd, shell = True, cwd = self.rundirs[host], env = env,
+                             stdout = PIPE, stderr = PIPE, close_fds = True,
+                             preexec_fn = self.limits(job, cpus, cgroup) )
+            job.set_process(process, host, self.spooldir)
+        except (OSError, IOError) as error:
+            self.free_cpus.extend(cpus)
+            if cgroup: self.remove_cgroup(cgroup)
+            raise StartingError(str(error))
+
+        self.pinned[job.id] = (job, cpus, cgroup)
+
+
+    def limits(self, job, cpus, cgroup):
+        # Runs in the child before the command is executed
+        memory = job.memory * self.memory_unit
+        def limit():
+            os.setsid()
+            if cgroup:
+                with open(path.join(cgroup, "cgroup.procs"), "w") as procs:
+                    procs.write("0")
+            if cpus:
+                util.set_affinity(cpus)
+            if memory:
+                resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        return limit
+
+
+    def make_cgroup(self, job):
+        cgroup = path.join(self.cgroup, "job%010d" % job.id)
+        if not path.isdir(cgroup): os.mkdir(cgroup)
+        with open(path.join(cgroup, "cpu.max"), "w") as cpu:
+            cpu.write("%d 100000" % (job.cores * 100000))
+        if job.memory:
+            with open(path.join(cgroup, "memory.max"), "w") as memory:
+                memory.write("%d" % (job.memory * self.memory_unit))
+        return cgroup
+
+    def remove_cgroup(self, cgroup):
+        try:
+            os.rmdir(cgroup)
+        except OSError:
+            pass
+
+
+    def reclaim(self):
+        # Give back the cpus and cgroups of returned jobs
+        for jobid, (job, cpus, cgroup) in self.pinned.items():
+            if job.process is None or job.process.poll() is not None:
+                del self.pinned[jobid]
+                self.free_cpus.extend(cpus)
+                if cgroup: self.remove_cgroup(cgroup)
+        self.free_cpus.sort()
 
 
+    def kill_job(self, daemon, job, host):
+        self.killpg(job.process.pid)
+        sleep(0.1)
+        return job.returned()
+
+    def killpg(self, pgid):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+    def reattach_job(self, daemon, job):
+        # The pipes of a job closed with the previous daemon, so it can't be
+        # followed again. If it is still running it is killed, so that it
+        # doesn't run twice once it is queued again
+        if job.running_host == self.host and job.pid and self.owns(job.pid, job.id):
+            self.killpg(job.pid)
+            if self.cgroup:
+                self.remove_cgroup(path.join(self.cgroup, "job%010d" % job.id))
+        return False
+
+    def owns(self, pid, jobid):
+        # Whether pid is still the process started for the job, and not a
+        # process that got the same pid later
+        try:
+            with open("/proc/%d/environ" % pid) as environ:
+                return "JODAEPY_JOB=%d" % jobid in environ.read().split("\0")
+        except (IOError, OSError):
+            return False
+
+    def close(self, daemon):
+        # Jobs run in their own session and would outlive the daemon
+        DirectoryHandler.close(self, daemon)
+        for jobid, (job, cpus, cgroup) in self.pinned.items():
+            if job.process is not None and job.process.poll() is None:
+                self.killpg(job.process.pid)
+        sleep(0.1)
+        self.reclaim()
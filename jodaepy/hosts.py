@@ -0,0 +1,132 @@
+
+import threading
+from Queue import Queue
+from time import sleep, time as now
+
+
+#
+# Cached host health
+#
+# The scheduler only reads the cached state of a host. A pool of worker
+# threads refreshes the cache in the background: working hosts are probed
+# again after ttl seconds, hosts that failed are cached as unavailable and
+# probed with an exponential backoff (retry, retry*backoff, ... up to
+# max_retry seconds).
+#
+
+class HostMonitor:
+
+    def __init__( self,
+                  check,
+                  hosts,
+                  ttl       = 60,
+                  retry     = 10,
+                  backoff   = 2.,
+                  max_retry = 600,
+                  workers   = 8,
+                  interval  = 1
+                ):
+
+        self.check     = check
+        self.hosts     = hosts
+        self.ttl       = ttl
+        self.retry     = retry
+        self.backoff   = backoff
+        self.max_retry = max_retry
+        self.workers   = workers
+        self.interval  = interval
+
+        self.lock    = threading.Lock()
+        self.cache   = {}       # host -> [available, checked, due, failures]
+        self.probing = set()
+        self.flipped = []       # hosts whose availability changed
+        self.queue   = Queue()
+
+        self.threads = []
+        self.quit    = False
+
+
+    def start(self):
+        for i in range(self.workers):
+            self._spawn(self._work)
+
+        # Probe every host once before scheduling starts
+        self.refresh(self.hosts)
+        self.queue.join()
+
+        self._spawn(self._watch)
+
+    def stop(self):
+        self.quit = True
+
+
+    def available(self, host):
+        with self.lock:
+            entry = self.cache.get(host)
+        if entry is None:
+            # Not probed yet (monitor not started): probe synchronously
+            return self.probe(host)
+        return entry[0]
+
+    def changed(self):
+        # Hosts whose availability changed since the last call
+        with self.lock:
+            hosts, self.flipped = self.flipped, []
+        return hosts
+
+    def mark_down(self, host):
+        # E.g. after a job failed to start on the host, which is probed
+        # again with the backoff of a failed probe
+        self._store(host, False)
+
+    def refresh(self, hosts):
+        with self.lock:
+            hosts = [ host for host in hosts if host not in self.probing ]
+            self.probing.update(hosts)
+        for host in hosts:
+            self.queue.put(host)
+
+
+    def probe(self, host):
+        try:
+            ok = bool(self.check(host))
+        except Exception:
+            ok = False
+        self._store(host, ok)
+        return ok
+
+    def _store(self, host, ok):
+        t = now()
+        with self.lock:
+            entry = self.cache.get(host, [None, None, None, 0])
+            if entry[0] != ok: self.flipped.append(host)
+            entry[3] = 0 if ok else entry[3] + 1
+            if ok: delay = self.ttl
+            else:  delay = min(self.max_retry, self.retry * self.backoff ** (entry[3] - 1))
+            entry[0:3] = [ok, t, t + delay]
+            self.cache[host] = entry
+
+
+    def _spawn(self, target):
+        thread = threading.Thread(target = target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _work(self):
+        while not self.quit:
+            host = self.queue.get()
+            try:
+                self.probe(host)
+            finally:
+                with self.lock:
+                    self.probing.discard(host)
+                self.queue.task_done()
+
+    def _watch(self):
+        while not self.quit:
+            t = now()
+            with self.lock:
+                due = [ host for host, entry in self.cache.items() if entry[2] <= t ]
+            self.refresh(due)
+            sleep(self.interval)
@@ -2,8 +2,14 @@
 # python standard modules
 import time
 import os
-import fcntl
-import re
+import errno
+
+from StringIO import StringIO
+from collections import namedtuple
+
+from pump import set_nonblocking
+from output import OutputBuffer
+from markers import MarkerParser
 
 
 class JobError(Exception):
@@ -13,14 +19,59 @@ class JobError(Exception):
 class HostNotAvailableError(JobError):
     pass
 
-class Job:
+
+def job_from_spec(spec):
+    # Inverse of Job.spec
+    job = Job( spec["cmd"],
+               title    = spec["title"],
+               descr    = spec["descr"],
+               id       = spec["id"],
+               project  = spec["project"],
+               hosts    = spec["hosts"],
+               tags     = spec["tags"],
+               priority = spec["priority"],
+               cores    = spec.get("cores", 1),
+               memory   = spec.get("memory", 0),
+               scratch  = spec.get("scratch", 0),
+               labels   = spec.get("labels", ()) )
+    job.depends      = spec.get("depends", [])
+    job.array_id     = spec.get("array")
+    job.script       = spec["script"]
+    job.running_host = spec["host"]
+    job.pid          = spec.get("pid")
+    job.stime        = spec["stime"]
+    job.ftime        = spec["ftime"]
+    job.retcode      = spec["retcode"]
+    job.perc         = spec["perc"]
+    job.perc_reported = job.perc
+    for outfile in spec["outfiles"]:
+        job.apply_markers([("file", outfile)])
+    return job
+
+
+class Job(object):
+
+    # Thousands of jobs are kept in memory, so there is no __dict__
+    __slots__ = ( "cmd", "project", "title", "descr", "id", "hosts", "tags",
+                  "after", "depends", "array_id", "priority",
+                  "cores", "memory", "scratch", "labels",
+                  "stdout", "stderr", "outfiles", "outfile_set",
+                  "eta", "metrics", "parser", "stime", "ftime", "perc",
+                  "perc_reported", "outfiles_reported",
+                  "process", "pid", "pump", "running_host", "retcode", "noerr", "script" )
+
     def __init__( self, cmd, title="", 
                   descr="", id=-1, 
                   project=None, 
                   hosts=None, 
                   tags=[],
                   script_backup=False,
-                  priority=0
+                  priority=0,
+                  cores=1,
+                  memory=0,
+                  scratch=0,
+                  labels=(),
+                  after=()
                 ):
 
         self.cmd    = cmd
@@ -29,55 +80,123 @@ class Job:
         self.descr  = descr
         self.id  = id
         self.hosts  = hosts
-        self.tags   = []
+        self.tags   = list(tags)
+
+        # Dependencies as given (ids, titles, tags or jobs) and resolved to
+        # jobids by the daemon, see dag.DependencyGraph
+        self.after   = list(after) if isinstance(after, (list, tuple)) else [after]
+        self.depends = []
 
-        self.stdout = []
-        self.stderr = []
+        # Id of the JobArray the job is a task of, see jobarray.JobArray
+        self.array_id = None
+
+        self.stdout = OutputBuffer()
+        self.stderr = OutputBuffer()
         self.priority = priority
 
+        # Requested resources, see scheduler.CapacityIndex
+        self.cores   = cores
+        self.memory  = memory
+        self.scratch = scratch
+        self.labels  = frozenset(labels)
+
         self.outfiles = []
+        self.outfile_set = set()
+
+        self.eta     = None
+        self.metrics = {}
+        self.parser  = MarkerParser()
 
         self.stime  = None
         self.ftime = None
 
         self.perc = 0
 
+        # state at the last call of update_status
+        self.perc_reported     = 0
+        self.outfiles_reported = []
+
         self.process = None
+        self.pid     = None     # of the local process, kept in the statefile
+        self.pump    = None
+        self.running_host = None
         self.retcode = None
+        self.noerr   = None
 
         self.script = cmd.split()[0] if script_backup else None
 
     def set_id( self, id ):
         self.id = id
 
+    def spec(self):
+        # Everything needed to restore the job, see job_from_spec
+        return { "cmd"      : self.cmd,
+                 "title"    : self.title,
+                 "descr"    : self.descr,
+                 "id"       : self.id,
+                 "project"  : self.project,
+                 "hosts"    : self.hosts,
+                 "tags"     : self.tags,
+                 "priority" : self.priority,
+                 "cores"    : self.cores,
+                 "memory"   : self.memory,
+                 "scratch"  : self.scratch,
+                 "labels"   : sorted(self.labels),
+                 "depends"  : self.depends,
+                 "array"    : self.array_id,
+                 "script"   : self.script,
+                 "host"     : self.running_host,
+                 "pid"      : self.pid,
+                 "stime"    : self.stime,
+                 "ftime"    : self.ftime,
+                 "retcode"  : self.retcode,
+                 "perc"     : self.perc,
+                 "outfiles" : self.outfiles }
+
 
     def read_stdout(self):
-        if not self.process: return ""
-        fd = self.process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-        try:
-            return self.process.stdout.read()
-        except:
-            return "" 
+        return self._read(self.process.stdout) if self.process else ""
 
     def read_stderr(self):
-        if not self.process: return ""
-        fd = self.process.stderr.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        return self._read(self.process.stderr) if self.process else ""
+
+    def _read(self, pipe):
+        # pipes are set to non-blocking in set_process
+        if pipe is None or pipe.closed: return ""
         try:
-            return self.process.stderr.read()
-        except:
-            return "" 
+            return pipe.read()
+        except IOError as error:
+            if error.errno == errno.EAGAIN: return ""
+            raise
+
 
+    def filenos(self):
+        if not self.process: return []
+        return [ pipe.fileno() for pipe in (self.process.stdout, self.process.stderr) if pipe ]
 
-    def set_process(self, process, host):
+
+    def set_process(self, process, host, spooldir = None):
         self.process = process
+        self.pid   = getattr(process, "pid", None)
         self.stime = time.strftime("%H:%M:%S, %d.%m.%Y")
-        self.stderr = []
-        self.stdout = []
+
+        # The complete output is spooled to disk if a spooldir is given,
+        # only the most recent output is kept in memory
+        if spooldir:
+            spool = os.path.join(spooldir, "%010d" % self.id)
+            self.stdout = OutputBuffer(spool + ".stdout")
+            self.stderr = OutputBuffer(spool + ".stderr")
+        else:
+            self.stdout = OutputBuffer()
+            self.stderr = OutputBuffer()
         self.outfiles = []
+        self.outfile_set = set()
+        self.parser = MarkerParser()
+        self.perc_reported     = self.perc
+        self.outfiles_reported = []
+
+        for fd in self.filenos():
+            set_nonblocking(fd)
 
         self.running_host = host
         self.retcode = None
@@ -88,7 +207,7 @@ class Job:
         return True if self.stime else False
 
     def returned(self):
-        if self.retcode: return True
+        if self.retcode is not None: return True
 
         self.retcode = self.process.poll()
 
@@ -108,34 +227,60 @@ class Job:
         
 
 
-    def update_status(self):
-
-        outfiles = []
-        info = None   # TODO
+    def feed(self, stream, data):
+        # Called with every new chunk of output, either by the output pump
+        # or by update_status
+        if stream == "stdout":
+            self.stdout.append(data)
+            self.apply_markers(self.parser.feed(data))
 
-        outfiles_old = list(self.outfiles) # copy the list
-        perc_old = self.perc
+        else:
+            self.stderr.append(data)
+
+    def end_stream(self, stream):
+        # Markers in a last line without line break
+        if stream == "stdout":
+            self.apply_markers(self.parser.flush())
+
+    def apply_markers(self, markers):
+        for kind, value in markers:
+            if kind == "perc":
+                self.perc = value
+            elif kind == "file":
+                if value not in self.outfile_set:
+                    self.outfile_set.add(value)
+                    self.outfiles.append(value)
+            elif kind == "eta":
+                self.eta = value
+            elif kind == "metric":
+                key, value = value
+                self.metrics[key] = value
 
-        stdout = self.read_stdout()
-        stderr = self.read_stderr()
 
-        if stdout:
-            self.stdout.append(stdout)
-            match = None
-            for match in re.finditer(r"!perc:[0-9]+", stdout): pass
-            if match: self.perc = int(match.group(0)[6:])
+    def update_status(self):
 
-            for match in re.finditer(r"!file:\".*?\"", stdout):
-                self.outfiles.append(match.group(0)[7:-1])
+        if self.pump:
+            self.pump.drain(self)
+        else:
+            stdout = self.read_stdout()
+            stderr = self.read_stderr()
+            if stdout: self.feed("stdout", stdout)
+            if stderr: self.feed("stderr", stderr)
 
-        if stderr:
-            self.stderr.append(stderr)
+        # Changes since the last call
+        perc_old, self.perc_reported = self.perc_reported, self.perc
+        outfiles_old, self.outfiles_reported = self.outfiles_reported, list(self.outfiles)
 
         return (perc_old, self.perc), (outfiles_old, self.outfiles)
 
 
 
     def joblog_str(self):
+        log = StringIO()
+        self.write_joblog(log)
+        return log.getvalue()
+
+    def write_joblog(self, log):
         
         if not self.returned():
             raise JobError("Can't create joblog for unfinished job")
@@ -152,27 +297,43 @@ class Job:
                           "START TIME: %s" % self.stime,
                           "FINISH TIME: %s" % self.ftime,
                           "FILES: %s" % ' '.join(self.outfiles),
+                          "METRICS: %s" % ' '.join( "%s=%s" % m for m in sorted(self.metrics.items()) ),
                           "\n",
                           "DESCRIPTION:\n%s" % self.descr,
-                          "\n",
-                          "STDOUT:\n%s" % ''.join(self.stdout),
-                          "\n",
-                          "STDERR:\n%s" % ''.join(self.stderr),
-                          "\n",
-                          "SCRIPT:\n%s" % "TODO" # TODO
                         ] )
-        return '\n'.join(content)
+        log.write('\n'.join(content))
+
+        # Output is streamed from the spool files
+        log.write("\n\n\nSTDOUT:\n")
+        self.stdout.write_to(log)
+        log.write("\n\n\nSTDERR:\n")
+        self.stderr.write_to(log)
+        log.write("\n\n\nSCRIPT:\n%s" % "TODO") # TODO
 
     def write_log(self, joblogdir):
 
         self.update_status()
+        self.end_stream("stdout")
 
         logpath = os.path.join(joblogdir, "%010d.jlog" % self.id)
 
         if self.returned():
             with open(logpath, "w") as log:
-                log.write(self.joblog_str())
-
+                self.write_joblog(log)
+
+    def compact(self, state = None):
+        # Finished jobs are only kept as a JobRecord. The process handle and
+        # its pipes are closed, the output is dropped. state is the final
+        # state ("finished" or "failed"), by default it follows the retcode
+        if self.process:
+            for pipe in (self.process.stdout, self.process.stderr, getattr(self.process, "stdin", None)):
+                if pipe and not pipe.closed: pipe.close()
+            self.process = None
+        self.stdout.release(0)
+        self.stderr.release(0)
+        return JobRecord( self.id, self.title, self.running_host, self.stime, self.ftime,
+                          self.retcode, tuple(self.outfiles), self.array_id,
+                          state or ("failed" if self.failed() else "finished") )
 
 
     def overview(self):
@@ -187,6 +348,8 @@ class Job:
             status = "failed"
 
         status += " (%d%%)" % self.perc
+        if self.eta is not None and self.started() and not self.returned():
+            status += ", %ds left" % self.eta
 
         content = []
         
@@ -202,7 +365,35 @@ class Job:
                           "FINISH TIME: %s" % self.ftime,
                           "FILES: %s" % ' '.join(self.outfiles),
                           "DESCRIPTION:\n%s" % self.descr,
-                          "STDOUT:\n%s" % ''.join(self.stdout[-5:]),
-                          "STDERR:\n%s" % ''.join(self.stderr[-5:]),
+                          "STDOUT:\n%s" % self.stdout.tail(1024),
+                          "STDERR:\n%s" % self.stderr.tail(1024),
                         ] )
         return '\n'.join(content)
+
+
+
+#
+# Finished job
+#
+# What is kept of a job after its finalization, see Job.compact. The full
+# job can still be loaded from the statefile, if there is one.
+#
+
+class JobRecord(namedtuple( "JobRecord", "id title running_host stime ftime "
+                                         "retcode outfiles array_id state" )):
+    __slots__ = ()
+
+    def started(self):  return True
+    def returned(self): return True
+    def failed(self):   return self.state == "failed"
+
+    def overview(self):
+        content = [ "STATUS: %s" % ("failed" if self.failed() else "finished"),
+                    "ID: %d" % self.id,
+                    "TITLE: %s" % self.title,
+                    "HOST: %s" % self.running_host,
+                    "START TIME: %s" % self.stime,
+                    "FINISH TIME: %s" % self.ftime,
+                    "FILES: %s" % ' '.join(self.outfiles),
+                  ]
+        return '\n'.join(content)
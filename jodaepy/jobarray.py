@@ -0,0 +1,227 @@
+
+from job import Job
+
+
+#
+# Array jobs
+#
+# A parameter sweep is registered as one JobArray instead of one Job per
+# point. The array stores the command template and a compact parameter
+# table, either the axes of a cartesian product (a dict of lists, the
+# points are never expanded) or a list of rows (dicts, tuples or lists, or
+# single values). The array gets one id, its tasks the following len(array)
+# ids.
+#
+# Tasks are ordinary Jobs, but they are only created when the previous one
+# left the queue, so there is at most one pending Job per array. The
+# daemon's registry keeps the number of tasks per state in array.counts.
+#
+#   JOBARRAY("./sim --L {L} --T {T}", {"L" : [8, 16, 32], "T" : temps})
+#   JOBARRAY("./fit {0} {1}", [("a", 1), ("b", 2)])
+#
+
+def array_from_spec(spec):
+    # Inverse of JobArray.spec
+    array = JobArray( spec["cmd"], [],
+                      title    = spec["title"],
+                      descr    = spec["descr"],
+                      id       = spec["id"],
+                      project  = spec["project"],
+                      hosts    = spec["hosts"],
+                      tags     = spec["tags"],
+                      priority = spec["priority"],
+                      cores    = spec["cores"],
+                      memory   = spec["memory"],
+                      scratch  = spec["scratch"],
+                      labels   = spec["labels"] )
+    array.names   = spec["names"]
+    array.axes    = spec["axes"]
+    array.rows    = [ tuple(row) for row in spec["rows"] ] if spec["rows"] is not None else None
+    array.size    = spec["size"]
+    array.script  = spec["script"]
+    array.depends = spec["depends"]
+    array.cursor  = spec["cursor"]
+    array.counts["dropped"] = spec["dropped"]
+    return array
+
+
+class JobArray:
+    def __init__( self, cmd, params,
+                  title="",
+                  descr="", id=-1,
+                  project=None,
+                  hosts=None,
+                  tags=[],
+                  script_backup=False,
+                  priority=0,
+                  cores=1,
+                  memory=0,
+                  scratch=0,
+                  labels=(),
+                  after=()
+                ):
+
+        self.cmd     = cmd
+        self.project = project
+        self.title   = title
+        self.descr   = descr
+        self.id      = id
+        self.hosts   = hosts
+        self.tags    = list(tags)
+
+        self.priority = priority
+        self.cores    = cores
+        self.memory   = memory
+        self.scratch  = scratch
+        self.labels   = frozenset(labels)
+
+        self.after   = list(after) if isinstance(after, (list, tuple)) else [after]
+        self.depends = []
+
+        self.script = cmd.split()[0] if script_backup else None
+
+        # Parameter table
+        if isinstance(params, dict):
+            self.names = sorted(params)
+            self.axes  = [ list(params[name]) for name in self.names ]
+            self.rows  = None
+            self.size  = reduce(lambda n, axis: n * len(axis), self.axes, 1)
+        else:
+            rows = list(params)
+            if rows and isinstance(rows[0], dict):
+                self.names = sorted(rows[0])
+                self.rows  = [ tuple(row[name] for name in self.names) for row in rows ]
+            else:
+                self.names = []
+                # Rows of jobfiles come as lists, they went through JSON
+                self.rows  = [ tuple(row) if isinstance(row, (list, tuple)) else (row,)
+                               for row in rows ]
+            self.axes  = None
+            self.size  = len(self.rows)
+
+        # "waiting" for dependencies, "pending" while tasks are left, then
+        # "finished" or "failed" (if any task failed), set by the daemon
+        self.state  = "waiting"
+        self.cursor = 0     # index of the next task to create
+        self.counts = { "pending"    : 0,
+                        "running"    : 0,
+                        "returned"   : 0,
+                        "finalizing" : 0,
+                        "failed"     : 0,
+                        "finished"   : 0,
+                        "dropped"    : 0 }
+
+    def __len__(self):
+        return self.size
+
+    def set_id( self, id ):
+        self.id = id
+
+    def spec(self):
+        # Everything needed to restore the array, see array_from_spec
+        return { "cmd"      : self.cmd,
+                 "title"    : self.title,
+                 "descr"    : self.descr,
+                 "id"       : self.id,
+                 "project"  : self.project,
+                 "hosts"    : self.hosts,
+                 "tags"     : self.tags,
+                 "priority" : self.priority,
+                 "cores"    : self.cores,
+                 "memory"   : self.memory,
+                 "scratch"  : self.scratch,
+                 "labels"   : sorted(self.labels),
+                 "depends"  : self.depends,
+                 "script"   : self.script,
+                 "names"    : self.names,
+                 "axes"     : self.axes,
+                 "rows"     : self.rows,
+                 "size"     : self.size,
+                 "cursor"   : self.cursor,
+                 "dropped"  : self.counts["dropped"] }
+
+
+    def values(self, index):
+        if self.rows is not None:
+            return self.rows[index]
+        # Last axis varies fastest
+        values = []
+        for axis in reversed(self.axes):
+            index, k = divmod(index, len(axis))
+            values.append(axis[k])
+        values.reverse()
+        return tuple(values)
+
+    def params(self, index):
+        values = self.values(index)
+        return dict(zip(self.names, values)) if self.names else values
+
+    def command(self, index):
+        values = self.values(index)
+        return self.cmd.format(*values, **dict(zip(self.names, values)))
+
+    def task(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError("Array %d has no task %d" % (self.id, index))
+        job = Job( self.command(index),
+                   title    = "%s[%d]" % (self.title, index),
+                   descr    = self.descr,
+                   id       = self.id + 1 + index,
+                   project  = self.project,
+                   hosts    = self.hosts,
+                   tags     = self.tags,
+                   priority = self.priority,
+                   cores    = self.cores,
+                   memory   = self.memory,
+                   scratch  = self.scratch,
+                   labels   = self.labels )
+        job.script   = self.script
+        job.array_id = self.id
+        return job
+
+    def index_of(self, jobid):
+        index = jobid - self.id - 1
+        return index if 0 <= index < self.size else None
+
+
+    def next_task(self):
+        # Creates the next task, None if all tasks were created
+        if self.cursor >= self.size: return None
+        self.cursor += 1
+        return self.task(self.cursor - 1)
+
+    def drop_rest(self):
+        # Tasks that were not created yet will never run
+        self.counts["dropped"] += self.size - self.cursor
+        self.cursor = self.size
+
+    def done(self):
+        return self.counts["finished"] + self.counts["failed"] + self.counts["dropped"] == self.size
+
+    def failed(self):
+        return self.counts["failed"] + self.counts["dropped"] > 0
+
+
+    def status(self):
+        # Number of tasks per state, tasks not created yet count as pending
+        status = dict(self.counts)
+        status["pending"] += self.size - self.cursor
+        return status
+
+
+    def overview(self):
+        status = self.status()
+        summary = ", ".join( "%d %s" % (status[state], state)
+                             for state in ("finished", "failed", "running", "returned",
+                                           "finalizing", "pending", "dropped")
+                             if status[state] )
+
+        content = [ "STATUS: %s (%s)" % (self.state, summary),
+                    "ID: %d" % self.id,
+                    "TITLE: %s" % self.title,
+                    "CMD: %s" % self.cmd,
+                    "PARAMS: %s" % ' '.join(self.names),
+                    "TASKS: %d (ids %d to %d)" % (self.size, self.id + 1, self.id + self.size),
+                    "DESCRIPTION:\n%s" % self.descr,
+                  ]
+        return '\n'.join(content)
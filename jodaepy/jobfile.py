@@ -0,0 +1,284 @@
+
+import os
+import json
+import errno
+import select
+import signal
+import hashlib
+import inspect
+import resource
+import __builtin__
+
+from collections import OrderedDict
+from time import time as now
+
+from job import Job
+from jobarray import JobArray
+from error import JobfileError
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    import toml
+except ImportError:
+    toml = None
+
+
+#
+# Loading jobfiles
+#
+# Declarative jobfiles (.json, .jsonl and, if the libraries are installed,
+# .yaml/.yml and .toml) describe jobs by the keyword arguments of Job, or
+# of JobArray if there is a "params" entry:
+#
+#   {"cmd" : "./sim 1", "title" : "first", "cores" : 4}
+#   {"cmd" : "./sim {L}", "params" : {"L" : [8, 16]}, "after" : ["first"]}
+#
+# A file holds one job, a list of jobs or a table {"jobs" : [...]}, JSON
+# lines files one job per line.
+#
+# Python jobfiles (.job) call JOB(...) and JOBARRAY(...). They run in a
+# forked child with a restricted set of builtins and importable modules,
+# limited in cpu time and memory, which is killed after `timeout` seconds.
+# The child only returns the arguments of the calls, the jobs are created
+# by the daemon. The restrictions keep jobfiles declarative, the child
+# keeps the daemon responsive, neither is a security boundary. Compiled
+# code is cached by the sha1 of the file.
+#
+
+extensions = (".job", ".json", ".jsonl", ".yaml", ".yml", ".toml")
+
+safe_builtins = ( "abs", "all", "any", "bool", "chr", "dict", "divmod", "enumerate",
+                  "filter", "float", "format", "frozenset", "hex", "int", "isinstance",
+                  "len", "list", "long", "map", "max", "min", "oct", "ord", "pow",
+                  "range", "reduce", "repr", "reversed", "round", "set", "slice",
+                  "sorted", "str", "sum", "tuple", "unichr", "unicode", "xrange", "zip",
+                  "True", "False", "None", "Exception", "ValueError", "TypeError",
+                  "KeyError", "IndexError" )
+
+safe_modules = ( "math", "cmath", "itertools", "functools", "operator", "random",
+                 "string", "re", "json", "collections", "datetime", "time",
+                 "fractions", "decimal" )
+
+
+class Handle(object):
+    # Stands for a job of the same file in after=...
+    __slots__ = ("index",)
+    def __init__(self, index):
+        self.index = index
+
+
+def _encode(value):
+    if isinstance(value, Handle): return {"local" : value.index}
+    if isinstance(value, (set, frozenset)): return sorted(value)
+    raise TypeError("%r can't be used in a jobfile" % (value,))
+
+
+def _kwargs(cls, args, kwargs):
+    # Positional arguments of JOB and JOBARRAY by name
+    names = inspect.getargspec(cls.__init__).args[1:]
+    if len(args) > len(names):
+        raise TypeError("Too many arguments for %s" % cls.__name__)
+    entry = dict(zip(names, args))
+    entry.update(kwargs)
+    return entry
+
+
+def _native(value):
+    # JSON and YAML give unicode, jobs use byte strings like execfile did
+    if isinstance(value, unicode): return value.encode("utf-8")
+    if isinstance(value, list):    return [ _native(v) for v in value ]
+    if isinstance(value, dict):    return dict( (_native(k), _native(v)) for k, v in value.items() )
+    return value
+
+
+def jobs_from_entries(entries):
+    # Entries are the keyword arguments of Job or JobArray
+    jobs = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise JobfileError("Expected a table of job arguments, got %r" % (entry,))
+        entry = _native(entry)
+
+        after = entry.pop("after", ())
+        if not isinstance(after, (list, tuple)): after = [after]
+        try:
+            entry["after"] = [ jobs[dep["local"]] if isinstance(dep, dict) else dep
+                               for dep in after ]
+        except (KeyError, IndexError):
+            raise JobfileError("Invalid dependency in %r" % (after,))
+
+        try:
+            if "params" in entry:
+                jobs.append(JobArray(**entry))
+            else:
+                jobs.append(Job(**entry))
+        except TypeError as error:
+            raise JobfileError("Invalid job %r: %s" % (entry, error))
+    return jobs
+
+
+class JobfileLoader:
+
+    def __init__( self,
+                  timeout   = 10.,
+                  memory    = 512 * 2**20,
+                  modules   = (),
+                  cachesize = 256
+                ):
+
+        self.timeout   = timeout
+        self.memory    = memory     # address space limit of the child in bytes
+        self.modules   = frozenset(safe_modules) | frozenset(modules)
+        self.cachesize = cachesize
+        self.code      = OrderedDict()  # sha1 -> code object, least recently used first
+
+
+    def load(self, jobpath):
+        # Returns the Jobs and JobArrays of a jobfile, raises JobfileError
+        with open(jobpath, "rb") as jobfile:
+            content = jobfile.read()
+
+        ext = os.path.splitext(jobpath)[1].lower()
+        if ext == ".job":
+            entries = self.run(self.compile(content, jobpath))
+        else:
+            entries = self.parse(content, ext)
+        return jobs_from_entries(entries)
+
+
+    def parse(self, content, ext):
+        try:
+            if ext == ".jsonl":
+                return [ json.loads(line) for line in content.splitlines() if line.strip() ]
+            elif ext == ".json":
+                data = json.loads(content)
+            elif ext in (".yaml", ".yml"):
+                if yaml is None: raise JobfileError("YAML jobfiles need PyYAML")
+                data = yaml.safe_load(content)
+            elif ext == ".toml":
+                if toml is None: raise JobfileError("TOML jobfiles need the toml package")
+                data = toml.loads(content)
+            else:
+                raise JobfileError("Unknown jobfile type '%s'" % ext)
+        except JobfileError:
+            raise
+        except Exception as error:
+            raise JobfileError("Could not parse jobfile: %s" % error)
+
+        if isinstance(data, dict):
+            for key in ("jobs", "job"):
+                if key in data: return data[key]
+            return [data]
+        return data if data is not None else []
+
+
+    def compile(self, content, jobpath):
+        key = hashlib.sha1(content).hexdigest()
+        code = self.code.pop(key, None)
+        if code is None:
+            try:
+                code = compile(content, jobpath, "exec")
+            except SyntaxError as error:
+                raise JobfileError("Syntax error in jobfile: %s" % error)
+        self.code[key] = code
+        while len(self.code) > self.cachesize:
+            self.code.popitem(last = False)
+        return code
+
+
+    def run(self, code):
+        # Executes the code in a child, returns the entries it reports
+        r, w = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            try:
+                os.close(r)
+                try:
+                    data = json.dumps({"entries" : self.execute(code)}, default = _encode)
+                except BaseException as error:
+                    data = json.dumps({"error" : "%s: %s" % (error.__class__.__name__, error)})
+                while data:
+                    data = data[os.write(w, data):]
+            finally:
+                os._exit(0)
+
+        os.close(w)
+        chunks = []
+        deadline = now() + self.timeout
+        try:
+            while True:
+                timeout = deadline - now()
+                if timeout <= 0:
+                    os.kill(pid, signal.SIGKILL)
+                    raise JobfileError("Jobfile did not finish within %g seconds" % self.timeout)
+                try:
+                    ready, _, _ = select.select([r], [], [], timeout)
+                except select.error as error:
+                    if error.args[0] != errno.EINTR: raise
+                    continue
+                if ready:
+                    chunk = os.read(r, 65536)
+                    if not chunk: break
+                    chunks.append(chunk)
+        finally:
+            os.close(r)
+            self._reap(pid)
+
+        try:
+            result = json.loads(''.join(chunks))
+        except ValueError:
+            raise JobfileError("Jobfile process died (memory or cpu time limit?)")
+        if "error" in result:
+            raise JobfileError(result["error"])
+        return result["entries"]
+
+
+    def execute(self, code):
+        # Runs in the child
+        if self.memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        cpu = int(self.timeout) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+
+        entries = []
+        def JOB(*args, **kwargs):
+            entries.append(_kwargs(Job, args, kwargs))
+            return Handle(len(entries) - 1)
+
+        def JOBARRAY(*args, **kwargs):
+            entries.append(_kwargs(JobArray, args, kwargs))
+            return Handle(len(entries) - 1)
+
+        builtins = dict( (name, getattr(__builtin__, name)) for name in safe_builtins )
+        builtins["__import__"] = self.importer()
+
+        namespace = { "__builtins__" : builtins,
+                      "__name__"     : "__jobfile__",
+                      "JOB"          : JOB,
+                      "JOBARRAY"     : JOBARRAY }
+        exec code in namespace
+        return entries
+
+    def importer(self):
+        modules = self.modules
+        def restricted_import(name, globals = None, locals = None, fromlist = (), level = -1):
+            if name not in modules:
+                raise ImportError("Module '%s' is not available in jobfiles" % name)
+            return __builtin__.__import__(name, globals, locals, fromlist, 0)
+        return restricted_import
+
+
+    def _reap(self, pid):
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                return
+            except OSError as error:
+                if error.errno == errno.EINTR: continue
+                if error.errno == errno.ECHILD: return
+                raise
@@ -0,0 +1,62 @@
+
+import re
+
+
+#
+# Progress markers in the stdout of a job
+#
+#   !perc:<percent>          progress in percent
+#   !file:"<path>"           result file to be committed
+#   !eta:<seconds>           estimated remaining runtime
+#   !metric:<key>=<value>    arbitrary named value
+#
+# Markers end with the line they are written in, so the parser only looks
+# at complete lines and carries the rest over to the next chunk. That way
+# a marker split across two reads (e.g. "!pe" | "rc:40") is still found.
+#
+
+MARKER = re.compile( r'!(?:perc:(?P<perc>[0-9]+)'
+                     r'|file:"(?P<file>[^"\r\n]*)"'
+                     r'|eta:(?P<eta>[0-9]+(?:\.[0-9]*)?)'
+                     r'|metric:(?P<key>[\w.-]+)=(?P<value>\S+))' )
+
+
+class MarkerParser:
+
+    # longest line fragment that is carried over to the next chunk
+    max_carry = 4096
+
+    def __init__(self):
+        self.carry = ""
+
+
+    def feed(self, data):
+        # Returns a list of (kind, value) pairs for all complete markers
+        data = self.carry + data
+
+        end = max(data.rfind("\n"), data.rfind("\r"))
+
+        if end < 0 and len(data) > self.max_carry:
+            # Overlong line, only keep what could be an unfinished marker
+            bang = data.rfind("!")
+            end = (bang if bang >= len(data) - self.max_carry else len(data)) - 1
+
+        self.carry = data[end + 1:]
+        return self._parse(data[:end + 1])
+
+    def flush(self):
+        data, self.carry = self.carry, ""
+        return self._parse(data)
+
+
+    def _parse(self, data):
+        if "!" not in data: return []
+
+        events = []
+        for match in MARKER.finditer(data):
+            perc, outfile, eta, key, value = match.group("perc", "file", "eta", "key", "value")
+            if   perc    is not None: events.append( ("perc", int(perc)) )
+            elif outfile is not None: events.append( ("file", outfile) )
+            elif eta     is not None: events.append( ("eta", float(eta)) )
+            else:                     events.append( ("metric", (key, value)) )
+        return events
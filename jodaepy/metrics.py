@@ -0,0 +1,190 @@
+
+import bisect
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from time import time as now
+
+
+#
+# Metrics
+#
+# Histograms of durations (e.g. of the phases of Daemon.core, of handler
+# calls and git commands), counters and gauges, all with labels, exported
+# in the Prometheus text format by MetricsServer. Gauges are functions that
+# are only evaluated on export and return a number or a list of
+# (labels, number). Observing is thread safe.
+#
+# Modules without access to the daemon record into `default`.
+#
+
+buckets = ( .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1,
+            .25, .5, 1., 2.5, 5., 10., 25., 60. )
+
+
+class Histogram:
+
+    def __init__(self, bounds = buckets):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # the last one is +Inf
+        self.sum    = 0.
+        self.count  = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name    = name
+        self.labels  = labels
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, now() - self.start, **self.labels)
+        return False
+
+
+def _labels(labels):
+    if not labels: return ""
+    return "{%s}" % ",".join( '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for key, value in labels )
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.help       = {}    # name -> help text
+        self.histograms = {}    # name -> {labels: Histogram}
+        self.counters   = {}    # name -> {labels: value}
+        self.gauges     = {}    # name -> function
+
+        # Called as profile(name, seconds, labels) for every observation
+        self.profile = None
+
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series: series[key] = Histogram()
+            series[key].observe(value)
+        if self.profile: self.profile(name, value, labels)
+
+    def timer(self, name, **labels):
+        # with metrics.timer("jodaepy_phase_seconds", phase = "control"): ...
+        return Timer(self, name, labels)
+
+    def timed(self, func, name, **labels):
+        # func, timed on every call
+        def timed_func(*args, **kwargs):
+            with self.timer(name, **labels):
+                return func(*args, **kwargs)
+        return timed_func
+
+
+    def inc(self, name, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name, func, text = None):
+        self.gauges[name] = func
+        if text: self.help[name] = text
+
+
+    def render(self):
+        lines = []
+        def header(name, kind):
+            if name in self.help:
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        with self.lock:
+            for name in sorted(self.histograms):
+                header(name, "histogram")
+                for key, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append( "%s_bucket%s %d" % (name, _labels(key + (("le", bound),)),
+                                                          cumulative) )
+                    lines.append("%s_sum%s %r" % (name, _labels(key), histogram.sum))
+                    lines.append("%s_count%s %d" % (name, _labels(key), histogram.count))
+
+            for name in sorted(self.counters):
+                header(name, "counter")
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append("%s%s %r" % (name, _labels(key), value))
+
+        for name in sorted(self.gauges):
+            try:
+                value = self.gauges[name]()
+            except Exception:
+                continue
+            header(name, "gauge")
+            if isinstance(value, list):
+                for labels, number in value:
+                    lines.append("%s%s %r" % (name, _labels(sorted(labels.items())), number))
+            else:
+                lines.append("%s %r" % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+default = Metrics()
+
+
+#
+# HTTP endpoint
+#
+
+class MetricsServer:
+
+    def __init__(self, metrics, port = 9108, address = "127.0.0.1"):
+        self.metrics = metrics
+        self.address = (address, port)
+        self.server  = None
+        self.thread  = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(self.address, Handler)
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join(1.)
+            self.server = None
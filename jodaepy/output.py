@@ -0,0 +1,78 @@
+
+import os
+import shutil
+from collections import deque
+
+
+#
+# Output buffer of a job
+#
+# Only the most recent `limit` bytes are kept in memory. If a spool path is
+# given, the complete output is appended to that file as well and can be
+# streamed from there (e.g. into the joblog) without ever being held in
+# memory as a whole.
+#
+
+class OutputBuffer:
+
+    def __init__(self, spoolpath = None, limit = 65536):
+        self.limit  = limit
+        self.chunks = deque()
+        self.size   = 0     # bytes in memory
+        self.total  = 0     # bytes seen
+
+        self.spoolpath = spoolpath
+        self.spool = open(spoolpath, "wb") if spoolpath else None
+
+
+    def __len__(self):
+        return self.total
+
+    def __str__(self):
+        if self.spool:
+            self.spool.flush()
+            with open(self.spoolpath, "rb") as spool:
+                return spool.read()
+        return self.tail()
+
+
+    def append(self, data):
+        self.total += len(data)
+        if self.spool: self.spool.write(data)
+
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size > self.limit and len(self.chunks) > 1:
+            self.size -= len(self.chunks.popleft())
+        if self.size > self.limit:
+            self.chunks[0] = self.chunks[0][-self.limit:]
+            self.size = len(self.chunks[0])
+
+    def tail(self, nbytes = None):
+        content = ''.join(self.chunks)
+        if nbytes is not None: content = content[-nbytes:]
+        if len(content) < self.total:
+            return "[...]\n" + content
+        return content
+
+
+    def write_to(self, stream):
+        if self.spool:
+            self.spool.flush()
+            with open(self.spoolpath, "rb") as spool:
+                shutil.copyfileobj(spool, stream)
+        else:
+            stream.write(self.tail())
+
+    def release(self, keep = 4096):
+        # Close and remove the spool file, keep only a short summary
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+            try:
+                os.remove(self.spoolpath)
+            except OSError:
+                pass
+        content = ''.join(self.chunks)[-keep:]
+        self.chunks = deque([content])
+        self.size = len(content)
@@ -0,0 +1,167 @@
+
+import os
+import errno
+import fcntl
+import select
+import threading
+
+
+def set_nonblocking(fd):
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+
+#
+# Output pump
+#
+# A background thread waits on the stdout and stderr pipes of all running
+# jobs and hands every chunk to Job.feed as soon as it arrives, so that no
+# job blocks on a full pipe between two control ticks. The main thread can
+# drain a job synchronously at any time (Job.update_status does). The jobs
+# that received output since the last call of updated() are recorded, so
+# that only their status has to be updated.
+#
+
+class OutputPump:
+
+    chunksize = 65536
+
+    def __init__(self, wakeup = None):
+        # wakeup is called with "status" whenever new output arrived
+        self.wakeup = wakeup
+
+        self.lock    = threading.Lock()
+        self.streams = {}   # fd -> (job, "stdout" | "stderr")
+        self.fds     = {}   # id(job) -> list of fds
+        self.changed = {}   # id(job) -> job, jobs with new output
+
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.flags  = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+        else:
+            self.poller = select.poll()
+            self.flags  = select.POLLIN | select.POLLHUP | select.POLLERR
+
+        # Self-pipe to interrupt the poller when streams change
+        self.poke_r, self.poke_w = os.pipe()
+        set_nonblocking(self.poke_r)
+        set_nonblocking(self.poke_w)
+        self.poller.register(self.poke_r, self.flags)
+
+        self.thread = None
+        self.quit   = False
+
+
+    def start(self):
+        self.quit = False
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.quit = True
+        self._poke()
+        if self.thread:
+            self.thread.join(1.)
+
+
+    def add(self, job):
+        if not job.process: return
+        with self.lock:
+            for name in ("stdout", "stderr"):
+                pipe = getattr(job.process, name)
+                if pipe is None: continue
+                fd = pipe.fileno()
+                set_nonblocking(fd)
+                self.streams[fd] = (job, name)
+                self.fds.setdefault(id(job), []).append(fd)
+                self.poller.register(fd, self.flags)
+        job.pump = self
+        self._poke()
+
+    def remove(self, job):
+        with self.lock:
+            for fd in list(self.fds.get(id(job), ())):
+                self._unregister(fd)
+            self.changed.pop(id(job), None)
+        job.pump = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def updated(self):
+        # Jobs that received output since the last call
+        with self.lock:
+            jobs = self.changed.values()
+            self.changed = {}
+        return jobs
+
+    def drain(self, job):
+        # Read everything that is available for the job right now
+        with self.lock:
+            for fd in list(self.fds.get(id(job), ())):
+                self._read(fd)
+
+
+    def _run(self):
+        while not self.quit:
+            try:
+                events = self.poller.poll()
+            except (IOError, select.error) as error:
+                if error.args[0] == errno.EINTR: continue
+                raise
+
+            if self.quit: break
+
+            new = False
+            with self.lock:
+                for fd, event in events:
+                    if fd == self.poke_r:
+                        self._flush_poke()
+                    elif fd in self.streams:
+                        job = self.streams[fd][0]
+                        if self._read(fd):
+                            self.changed[id(job)] = job
+                            new = True
+
+            if new and self.wakeup:
+                self.wakeup("status")
+
+    def _read(self, fd):
+        job, name = self.streams[fd]
+        new = False
+        while True:
+            try:
+                data = os.read(fd, self.chunksize)
+            except OSError as error:
+                if error.errno == errno.EAGAIN: break
+                data = ""
+            if not data:
+                self._unregister(fd)
+                job.end_stream(name)
+                break
+            job.feed(name, data)
+            new = True
+        return new
+
+    def _unregister(self, fd):
+        job, name = self.streams.pop(fd)
+        fds = self.fds[id(job)]
+        fds.remove(fd)
+        if not fds: del self.fds[id(job)]
+        try:
+            self.poller.unregister(fd)
+        except (IOError, KeyError, ValueError):
+            pass
+
+    def _poke(self):
+        try:
+            os.write(self.poke_w, "p")
+        except OSError as error:
+            if error.errno != errno.EAGAIN: raise
+
+    def _flush_poke(self):
+        try:
+            while os.read(self.poke_r, 4096): pass
+        except OSError as error:
+            if error.errno != errno.EAGAIN: raise
@@ -0,0 +1,107 @@
+
+from collections import OrderedDict
+
+
+#
+# Index of all jobs known to the daemon
+#
+# Every job lives in exactly one state. Besides the id -> job dictionary
+# there is one ordered dictionary per state and, for running jobs, one per
+# host, so that lookup, state changes and removal do not depend on the
+# number of jobs. The tasks of array jobs are also counted per state, in
+# array.counts.
+#
+
+class JobRegistry:
+
+    states = ("waiting", "pending", "running", "returned", "finalizing", "failed", "finished")
+
+    def __init__(self, hosts, store = None):
+        # All changes are recorded in the (optional) persistent store
+        self.store = store
+
+        self.jobs  = {}     # jobid -> job
+        self.state = {}     # jobid -> state
+
+        self.by_state = {}
+        for state in self.states:
+            self.by_state[state] = OrderedDict()
+
+        self.by_host = {}   # running jobs, one dictionary for every host
+        for host in hosts:
+            self.by_host[host] = OrderedDict()
+
+        self.arrays = {}    # arrayid -> JobArray
+
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, job):
+        return self.jobs.get(job.id) is job
+
+
+    def add(self, job, state = "pending", record = True):
+        if job.id in self.jobs:
+            raise KeyError("Job %d already registered" % job.id)
+        self.jobs[job.id] = job
+        self._enter(job, state)
+        if record and self.store: self.store.record(job, state)
+
+    def move(self, job, state):
+        self._leave(job)
+        self._enter(job, state)
+        if self.store: self.store.record(job, state)
+
+    def replace(self, job, record):
+        # Swap a job for its compacted record, see Job.compact
+        state = self.state[job.id]
+        self.jobs[job.id] = record
+        self.by_state[state][job.id] = record
+
+    def remove(self, job):
+        if job not in self: return
+        self._leave(job)
+        del self.jobs[job.id]
+        del self.state[job.id]
+        if self.store: self.store.forget(job)
+
+
+    def track(self, array):
+        self.arrays[array.id] = array
+
+
+    def get(self, jobid, default = None):
+        return self.jobs.get(jobid, default)
+
+    def state_of(self, job):
+        return self.state.get(job.id)
+
+    def jobs_in(self, state):
+        return self.by_state[state].values()
+
+    def running_on(self, host):
+        return self.by_host[host].values()
+
+    def count(self, state):
+        return len(self.by_state[state])
+
+    def count_on(self, host):
+        return len(self.by_host[host])
+
+
+    def _enter(self, job, state):
+        self.state[job.id] = state
+        self.by_state[state][job.id] = job
+        if state == "running":
+            self.by_host[job.running_host][job.id] = job
+        if job.array_id in self.arrays:
+            self.arrays[job.array_id].counts[state] += 1
+
+    def _leave(self, job):
+        state = self.state[job.id]
+        del self.by_state[state][job.id]
+        if state == "running":
+            del self.by_host[job.running_host][job.id]
+        if job.array_id in self.arrays:
+            self.arrays[job.array_id].counts[state] -= 1
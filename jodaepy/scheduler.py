@@ -0,0 +1,296 @@
+
+import heapq
+import bisect
+from time import time as now
+
+
+#
+# Queue of pending jobs
+#
+# Jobs are kept in a heap keyed by (-priority, id), so that jobs with a
+# higher priority start first and jobs of equal priority start in the
+# order of registration. Removed jobs are only marked and dropped lazily
+# when they reach the top of the heap. The number of pending jobs per
+# requested cores is counted, so that the smallest request is known
+# without walking the heap.
+#
+
+class PendingQueue:
+
+    def __init__(self):
+        self.heap    = []
+        self.entries = {}   # jobid -> heap entry
+        self.cores   = {}   # requested cores -> number of pending jobs
+
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, job):
+        return job.id in self.entries
+
+
+    def push(self, job):
+        if job.id in self.entries:
+            self.remove(job)
+        entry = [-job.priority, job.id, job]
+        self.entries[job.id] = entry
+        self.cores[job.cores] = self.cores.get(job.cores, 0) + 1
+        heapq.heappush(self.heap, entry)
+
+    def pop(self):
+        while self.heap:
+            priority, jobid, job = heapq.heappop(self.heap)
+            if job is not None:
+                del self.entries[jobid]
+                self._uncount(job)
+                return job
+        raise IndexError("pop from empty queue")
+
+    def remove(self, job):
+        entry = self.entries.pop(job.id, None)
+        if entry:
+            self._uncount(entry[-1])
+            entry[-1] = None
+
+    def _uncount(self, job):
+        self.cores[job.cores] -= 1
+        if not self.cores[job.cores]: del self.cores[job.cores]
+
+    def min_cores(self):
+        # Smallest number of cores requested by a pending job
+        return min(self.cores) if self.cores else None
+
+
+    def jobs(self):
+        return [ entry[-1] for entry in sorted(self.entries.values()) ]
+
+    def peek(self):
+        while self.heap and self.heap[0][-1] is None:
+            heapq.heappop(self.heap)
+        return self.heap[0][-1] if self.heap else None
+
+
+    # Accounting hooks, called by the daemon
+    def started(self, job):  pass
+    def returned(self, job): pass
+
+
+#
+# Fair-share queue
+#
+# One PendingQueue per project. The next job is taken from the project
+# with the smallest share, where the share of a project is
+#
+#   (cores running now + decayed usage / halflife) / weight
+#
+# The usage is the sum of cores * runtime of the returned jobs of the
+# project and decays by half every `halflife` seconds, so the second term
+# is roughly the number of cores the project kept busy recently. Projects
+# can be capped to a number of running cores by quotas. The clock can be
+# replaced for simulations.
+#
+
+class FairShareQueue:
+
+    def __init__( self,
+                  weights        = None,
+                  quotas         = None,
+                  halflife       = 86400.,
+                  default_weight = 1.,
+                  clock          = now
+                ):
+
+        self.weights        = weights if weights else {}
+        self.quotas         = quotas if quotas else {}
+        self.halflife       = halflife
+        self.default_weight = default_weight
+        self.clock          = clock
+
+        self.queues  = {}   # project -> PendingQueue
+        self.project = {}   # jobid -> project of pending jobs
+        self.usage   = {}   # project -> (usage, time of last decay)
+        self.running = {}   # project -> running cores
+        self.starts  = {}   # jobid -> start time of running jobs
+
+
+    def __len__(self):
+        return len(self.project)
+
+    def __contains__(self, job):
+        return job.id in self.project
+
+
+    def push(self, job):
+        self.remove(job)
+        self.project[job.id] = job.project
+        self.queues.setdefault(job.project, PendingQueue()).push(job)
+
+    def pop(self):
+        # Returns None if every project with pending jobs is at its quota
+        # Jobs without a project are queued under None, so best_key tells
+        # whether a project was found
+        best, best_key = None, None
+        for project, queue in self.queues.items():
+            job = queue.peek()
+            if job is None: continue
+
+            quota = self.quotas.get(project)
+            if quota is not None and self.running.get(project, 0) + job.cores > quota:
+                continue
+
+            key = (self.share(project), -job.priority, job.id)
+            if best_key is None or key < best_key:
+                best, best_key = project, key
+
+        if best_key is None:
+            if not self.project: raise IndexError("pop from empty queue")
+            return None
+
+        job = self.queues[best].pop()
+        del self.project[job.id]
+        return job
+
+    def remove(self, job):
+        if job.id in self.project:
+            self.queues[self.project.pop(job.id)].remove(job)
+
+    def jobs(self):
+        jobs = []
+        for queue in self.queues.values(): jobs.extend(queue.jobs())
+        return sorted(jobs, key = lambda job: (-job.priority, job.id))
+
+    def min_cores(self):
+        requests = [ queue.min_cores() for queue in self.queues.values() if queue ]
+        return min(requests) if requests else None
+
+
+    def share(self, project):
+        weight = self.weights.get(project, self.default_weight)
+        return (self.running.get(project, 0) + self.decayed(project) / self.halflife) / weight
+
+    def decayed(self, project):
+        usage, stamp = self.usage.get(project, (0., None))
+        if stamp is None: return usage
+        return usage * 0.5 ** ((self.clock() - stamp) / self.halflife)
+
+
+    def started(self, job):
+        self.starts[job.id] = self.clock()
+        self.running[job.project] = self.running.get(job.project, 0) + job.cores
+
+    def returned(self, job):
+        start = self.starts.pop(job.id, None)
+        if start is None: return
+        self.running[job.project] -= job.cores
+        t = self.clock()
+        self.usage[job.project] = (self.decayed(job.project) + job.cores * (t - start), t)
+
+
+#
+# Free resources of the hosts
+#
+# Hosts declare capacities for "cores", "memory" and "scratch" (None means
+# unlimited) and a set of "labels" (e.g. "gpu"). Jobs request amounts of
+# the resources and a set of labels. The index keeps the hosts bucketed by
+# their number of free cores, so that the best fitting host (the one with
+# the fewest free cores that can take the job) is found without looking at
+# hosts that are too full anyway.
+#
+
+class CapacityIndex:
+
+    resources = ("cores", "memory", "scratch")
+
+    def __init__(self, capacities):
+        self.capacity = {}   # host -> {resource: amount}
+        self.labels   = {}   # host -> frozenset of labels
+        self.free     = {}   # host -> {resource: amount}
+
+        self.buckets  = {}   # free cores -> set of available hosts
+        self.levels   = []   # sorted list of the keys of buckets
+        self.down     = set()   # unavailable hosts, not in buckets
+        self.free_cores = 0     # on available hosts
+
+        for host, capacity in capacities.items():
+            self.capacity[host] = dict( (r, capacity.get(r)) for r in self.resources )
+            self.labels[host]   = frozenset(capacity.get("labels", ()))
+            self.free[host]     = dict(self.capacity[host])
+            self._insert(host)
+            self.free_cores += self.free[host]["cores"]
+
+
+    def request(self, job):
+        return { "cores"   : job.cores,
+                 "memory"  : job.memory,
+                 "scratch" : job.scratch }
+
+    def fits(self, host, job, free = None):
+        free = self.free[host] if free is None else free
+        if not self.labels[host].issuperset(job.labels): return False
+        for resource, amount in self.request(job).items():
+            if free[resource] is not None and amount > free[resource]: return False
+        return True
+
+    def could_fit(self, job, hosts = None):
+        # Whether the job fits on any of the hosts when they are empty
+        hosts = self.capacity.keys() if hosts is None else hosts
+        return any( host in self.capacity and self.fits(host, job, self.capacity[host])
+                    for host in hosts )
+
+
+    def best_fit(self, job, usable = lambda host: True):
+        # Hosts with labels the job doesn't need (e.g. GPU nodes) are only
+        # used if no other host fits
+        start = bisect.bisect_left(self.levels, job.cores)
+        for plain in (True, False):
+            for level in self.levels[start:]:
+                for host in self.buckets[level]:
+                    if plain and self.labels[host] - job.labels: continue
+                    if usable(host) and self.fits(host, job):
+                        return host
+        return None
+
+
+    def set_available(self, host, available):
+        # Free resources of unavailable hosts are not offered
+        if available and host in self.down:
+            self.down.discard(host)
+            self._insert(host)
+            self.free_cores += self.free[host]["cores"]
+        elif not available and host not in self.down and host in self.free:
+            self._remove(host)
+            self.down.add(host)
+            self.free_cores -= self.free[host]["cores"]
+
+
+    def allocate(self, host, job):
+        self._update(host, job, -1)
+
+    def release(self, host, job):
+        self._update(host, job, +1)
+
+
+    def _update(self, host, job, sign):
+        up = host not in self.down
+        if up: self._remove(host)
+        for resource, amount in self.request(job).items():
+            if self.free[host][resource] is not None:
+                self.free[host][resource] += sign * amount
+        if up:
+            self.free_cores += sign * job.cores
+            self._insert(host)
+
+    def _insert(self, host):
+        level = self.free[host]["cores"]
+        if level not in self.buckets:
+            self.buckets[level] = set()
+            bisect.insort(self.levels, level)
+        self.buckets[level].add(host)
+
+    def _remove(self, host):
+        level = self.free[host]["cores"]
+        self.buckets[level].discard(host)
+        if not self.buckets[level]:
+            del self.buckets[level]
+            del self.levels[bisect.bisect_left(self.levels, level)]
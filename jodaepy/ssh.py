@@ -0,0 +1,99 @@
+
+import os
+import shutil
+import tempfile
+import threading
+
+from subprocess import Popen
+from time import time as now
+
+
+#
+# Persistent ssh connections
+#
+# One OpenSSH master connection (ControlMaster) is kept per host and every
+# job launch and health probe is multiplexed over it, so only the first
+# command pays for the TCP and key exchange handshake. A master closes
+# itself after being idle for `persist` seconds and is started again the
+# next time the host is used.
+#
+
+class SSHConnections:
+
+    def __init__( self,
+                  controldir = None,
+                  persist    = 600,
+                  options    = ("-o", "BatchMode=yes"),
+                  recheck    = 30
+                ):
+
+        # A temporary controldir is removed again by close_all
+        self.owned      = not controldir
+        self.controldir = controldir if controldir else tempfile.mkdtemp(prefix = "jodaepy-ssh-")
+        self.persist    = persist
+        self.options    = list(options)
+        self.recheck    = recheck
+
+        # unix socket paths are short, so let ssh hash the host (%C)
+        self.controlpath = os.path.join(self.controldir, "%C")
+
+        self.lock    = threading.Lock()
+        self.locks   = {}   # host -> lock, hosts are connected concurrently
+        self.checked = {}   # host -> time of the last successful check
+
+
+    def command(self, host, rcmd = None):
+        # If the master is gone, ControlMaster=auto lets this connection
+        # work on its own instead of failing
+        self.ensure(host)
+        cmd = ["ssh"] + self.options + \
+              [ "-o", "ControlMaster=auto",
+                "-o", "ControlPath=%s" % self.controlpath,
+                host ]
+        if rcmd: cmd.append(rcmd)
+        return cmd
+
+
+    def ensure(self, host):
+        with self._lock(host):
+            checked = self.checked.get(host)
+            if checked and now() - checked < self.recheck:
+                return True
+            if self.alive(host) or self.connect(host):
+                self.checked[host] = now()
+                return True
+            self.checked.pop(host, None)
+            return False
+
+    def alive(self, host):
+        return self._ssh(host, ["-O", "check"]) == 0
+
+    def connect(self, host):
+        opts = [ "-o", "ControlMaster=yes",
+                 "-o", "ControlPersist=%d" % self.persist,
+                 "-N", "-f" ]
+        return self._ssh(host, opts) == 0
+
+    def close(self, host):
+        with self._lock(host):
+            self.checked.pop(host, None)
+            return self._ssh(host, ["-O", "exit"]) == 0
+
+    def close_all(self):
+        for host in list(self.locks):
+            self.close(host)
+        if self.owned:
+            shutil.rmtree(self.controldir, ignore_errors = True)
+
+
+    def _lock(self, host):
+        with self.lock:
+            return self.locks.setdefault(host, threading.Lock())
+
+    def _ssh(self, host, opts):
+        cmd = ["ssh"] + self.options + opts + \
+              [ "-o", "ControlPath=%s" % self.controlpath, host ]
+        with open(os.devnull, "r+") as devnull:
+            process = Popen(cmd, stdin = devnull, stdout = devnull, stderr = devnull)
+            process.communicate()
+        return process.returncode
@@ -0,0 +1,110 @@
+
+import json
+import sqlite3
+
+from job import job_from_spec
+from jobarray import array_from_spec
+
+
+#
+# Persistent daemon state
+#
+# Every registration and state change of a job is written to an SQLite
+# database in WAL mode, together with the id counter. The daemon commits
+# once per core iteration. After a crash or restart only the jobs that are
+# still active (waiting, pending, running, returned, finalizing) are loaded,
+# historical jobs stay on disk and are read on demand. Array jobs are kept
+# in a table of their own, their tasks are recorded like jobs once created.
+#
+
+class StateStore:
+
+    active = ("waiting", "pending", "running", "returned", "finalizing")
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute( "CREATE TABLE IF NOT EXISTS jobs ("
+                         " id INTEGER PRIMARY KEY,"
+                         " state TEXT NOT NULL,"
+                         " spec TEXT NOT NULL)" )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self.db.execute( "CREATE TABLE IF NOT EXISTS arrays ("
+                         " id INTEGER PRIMARY KEY,"
+                         " state TEXT NOT NULL,"
+                         " spec TEXT NOT NULL)" )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS meta ("
+                         " key TEXT PRIMARY KEY,"
+                         " value TEXT NOT NULL)" )
+        self.db.commit()
+
+
+    def record(self, job, state):
+        self.db.execute( "INSERT OR REPLACE INTO jobs (id, state, spec) VALUES (?, ?, ?)",
+                         (job.id, state, json.dumps(job.spec())) )
+
+    def forget(self, job):
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+
+    def record_array(self, array):
+        self.db.execute( "INSERT OR REPLACE INTO arrays (id, state, spec) VALUES (?, ?, ?)",
+                         (array.id, array.state, json.dumps(array.spec())) )
+
+
+    def set_next_id(self, next_id):
+        self.db.execute( "INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)",
+                         (str(next_id),) )
+
+    def next_id(self, default = 0):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        return int(row[0]) if row else default
+
+
+    def load(self, states = active):
+        # Returns a list of (state, job) ordered by id
+        query = "SELECT state, spec FROM jobs WHERE state IN (%s) ORDER BY id" % \
+                ", ".join("?" * len(states))
+        return [ (state, job_from_spec(json.loads(spec)))
+                 for state, spec in self.db.execute(query, states) ]
+
+    def load_arrays(self, states = ("waiting", "pending")):
+        # Returns a list of arrays ordered by id. Tasks that are not active
+        # anymore are counted in array.counts, the cursor is moved past the
+        # tasks created before
+        query = "SELECT state, spec FROM arrays WHERE state IN (%s) ORDER BY id" % \
+                ", ".join("?" * len(states))
+        arrays = []
+        for state, spec in self.db.execute(query, states).fetchall():
+            array = array_from_spec(json.loads(spec))
+            array.state = state
+            bounds = (array.id + 1, array.id + len(array))
+            for task_state, count in self.db.execute(
+                    "SELECT state, COUNT(*) FROM jobs WHERE id BETWEEN ? AND ? GROUP BY state", bounds):
+                if task_state not in self.active:
+                    array.counts[task_state] += count
+            last = self.db.execute("SELECT MAX(id) FROM jobs WHERE id BETWEEN ? AND ?", bounds).fetchone()[0]
+            if last is not None:
+                array.cursor = max(array.cursor, last - array.id)
+            arrays.append(array)
+        return arrays
+
+    def state_of(self, jobid):
+        row = self.db.execute("SELECT state FROM jobs WHERE id = ?", (jobid,)).fetchone()
+        if row is None:
+            row = self.db.execute("SELECT state FROM arrays WHERE id = ?", (jobid,)).fetchone()
+        return row[0] if row else None
+
+    def load_job(self, jobid):
+        row = self.db.execute("SELECT spec FROM jobs WHERE id = ?", (jobid,)).fetchone()
+        return job_from_spec(json.loads(row[0])) if row else None
+
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -1,8 +1,12 @@
 
 import os
 import shutil
+import ctypes
+import ctypes.util
+import threading
 import subprocess as sp
 
+import metrics
 from error import GitExecError
 
 
@@ -12,16 +16,51 @@ def move_to_dir(source, target_dir):
     shutil.move(source, target)
 
 
+_repo_locks = {}
+_repo_locks_lock = threading.Lock()
+
+def repo_lock(path):
+    # One lock per git repository (found by looking for .git upwards), held
+    # around multi-step git transactions that may run in worker threads
+    root = os.path.realpath(path)
+    while not os.path.exists(os.path.join(root, '.git')):
+        parent = os.path.dirname(root)
+        if parent == root:
+            root = os.path.realpath(path)
+            break
+        root = parent
+    with _repo_locks_lock:
+        return _repo_locks.setdefault(root, threading.RLock())
+
+
+metrics.default.describe("jodaepy_git_seconds", "Duration of git commands")
+
 def git_execute(git_cmd, path):
-    pipe = sp.Popen(git_cmd, cwd = path, stdout = sp.PIPE, stderr = sp.PIPE)
-    outdata, errdata = pipe.communicate()
+    with metrics.default.timer("jodaepy_git_seconds", command = git_cmd[1]):
+        pipe = sp.Popen(git_cmd, cwd = path, stdout = sp.PIPE, stderr = sp.PIPE)
+        outdata, errdata = pipe.communicate()
     if pipe.returncode != 0: raise GitExecError(errdata)
+    return outdata
 
 
 def git_pull(path):
     git_execute(['git', 'pull'], path)
 
 
+def git_remote_changed(path):
+    # Compare the upstream branch with the remote without fetching
+    try:
+        upstream = git_execute(['git', 'rev-parse', '--abbrev-ref',
+                                '--symbolic-full-name', '@{u}'], path).strip()
+        local = git_execute(['git', 'rev-parse', '@{u}'], path).strip()
+    except GitExecError:
+        return True # no upstream known, let git pull decide
+
+    remote, branch = upstream.split('/', 1)
+    remote_ref = git_execute(['git', 'ls-remote', remote, 'refs/heads/' + branch], path).split()
+    return not remote_ref or remote_ref[0] != local
+
+
 def git_push(path):
     git_execute(['git', 'push'], path)
 
@@ -37,6 +76,42 @@ def git_commit(path, message):
     git_cmd = ['git', 'commit', '-m', message]
     git_execute(git_cmd, path)
 
+def git_staged(path):
+    # Whether the index has changes to commit
+    try:
+        git_execute(['git', 'diff', '--cached', '--quiet'], path)
+    except GitExecError:
+        return True
+    return False
+
+def git_reset(path):
+    # Unstage everything, the working tree is kept
+    git_execute(['git', 'reset', '-q'], path)
+
 def git_commit_all(path, message):
     git_cmd = ['git', 'commit', '-a', '-m', message]
     git_execute(git_cmd, path)
+
+
+def _libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+    except OSError:
+        return None
+
+# The C library, for system calls without a Python interface (None if it
+# can't be loaded)
+libc = _libc()
+
+
+def set_affinity(cpus, pid = 0):
+    # Bind a process (0: the calling one) to a list of cpus
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (max(cpus) // bits + 1))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    if libc is None or not hasattr(libc, "sched_setaffinity"):
+        raise OSError("sched_setaffinity is not available")
+    if libc.sched_setaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
@@ -0,0 +1,178 @@
+
+import os
+import errno
+import struct
+import ctypes
+
+from collections import OrderedDict
+
+from util import libc
+
+
+#
+# Watching directories
+#
+# Both watchers report changes as a list of (key, name, present), where
+# key is the one given to watch(path, key), name the file name in that
+# directory and present whether the file was added (or written) or removed.
+# A name of None means that the watcher lost track of the directory and it
+# has to be scanned again, if present is False the directory itself was
+# removed and has to be watched again with watch().
+#
+# InotifyWatcher (Linux) reports files once they are completely written or
+# moved into the directory and can be select()ed via fileno().
+# PollingWatcher only looks into a directory if its mtime changed, so that
+# nothing is scanned while idle, but changes of the content of existing
+# files are not noticed.
+#
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+
+MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+       IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT = struct.Struct("iIII")   # wd, mask, cookie, len
+
+
+def watcher():
+    # The best watcher available on this system
+    if libc is not None and hasattr(libc, "inotify_init1"):
+        try:
+            return InotifyWatcher()
+        except OSError:
+            pass
+    return PollingWatcher()
+
+
+class InotifyWatcher:
+
+    def __init__(self):
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.watches = {}   # wd -> (path, key)
+
+
+    def fileno(self):
+        return self.fd
+
+    def watch(self, path, key):
+        wd = libc.inotify_add_watch(self.fd, path, MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, "%s: %s" % (os.strerror(error), path))
+        self.watches[wd] = (path, key)
+
+
+    def changes(self):
+        changes = []
+        for wd, mask, name in self._events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost
+                changes.extend( (key, None, True) for path, key in self.watches.values() )
+                continue
+
+            if wd not in self.watches: continue
+            path, key = self.watches[wd]
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # The watch is gone (or follows the moved directory), the
+                # directory has to be watched again
+                del self.watches[wd]
+                if mask & IN_MOVE_SELF:
+                    libc.inotify_rm_watch(self.fd, wd)
+                changes.append((key, None, False))
+            elif mask & IN_ISDIR:
+                continue
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changes.append((key, name, True))
+            elif mask & IN_CREATE:
+                # Regular files are reported when they are closed, symlinks
+                # are complete when they are created
+                if os.path.islink(os.path.join(path, name)):
+                    changes.append((key, name, True))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.append((key, name, False))
+        return changes
+
+    def _events(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EINTR): return events
+                raise
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                events.append((wd, mask, name))
+
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = None
+
+
+class PollingWatcher:
+
+    def __init__(self):
+        self.dirs = OrderedDict()   # path -> [key, mtime of path, {name: mtime}]
+
+
+    def fileno(self):
+        return None
+
+    def watch(self, path, key):
+        self.dirs[path] = [key, os.path.getmtime(path), self._listing(path)]
+
+
+    def changes(self):
+        changes = []
+        for path, entry in self.dirs.items():
+            key, mtime, listing = entry
+            try:
+                new_mtime = os.path.getmtime(path)
+            except OSError:
+                changes.append((key, None, False))
+                continue
+            if new_mtime == mtime: continue
+
+            new_listing = self._listing(path)
+            for name, file_mtime in new_listing.items():
+                if listing.get(name) != file_mtime:
+                    changes.append((key, name, True))
+            for name in listing:
+                if name not in new_listing:
+                    changes.append((key, name, False))
+            entry[1:] = [new_mtime, new_listing]
+        return changes
+
+    def _listing(self, path):
+        listing = {}
+        for name in os.listdir(path):
+            try:
+                listing[name] = os.path.getmtime(os.path.join(path, name))
+            except OSError:
+                pass
+        return listing
+
+
+    def close(self):
+        self.dirs.clear()
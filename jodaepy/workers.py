@@ -0,0 +1,125 @@
+
+import threading
+from collections import deque, OrderedDict
+from Queue import Queue, Empty
+from time import time as now
+
+
+#
+# Worker pool with per-key serialization
+#
+# Tasks are submitted with a key, tasks sharing a key run one after the
+# other in submission order (e.g. all git operations on one rundir), tasks
+# with different keys run concurrently on up to `workers` threads. Results
+# are collected by the main thread with done().
+#
+
+class Task:
+    def __init__(self, key, tag, func, args):
+        self.key  = key
+        self.tag  = tag
+        self.func = func
+        self.args = args
+
+        self.submitted = now()
+        self.result    = None
+        self.error     = None
+
+
+class WorkerPool:
+
+    def __init__(self, workers = 4, maxsize = 16, notify = None):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.notify  = notify   # called with "worker" when a task is done
+
+        self.cond    = threading.Condition()
+        self.queues  = OrderedDict()    # key -> deque of waiting tasks
+        self.ready   = deque()          # keys with waiting tasks and no running task
+        self.running = {}               # key -> running task
+        self.count   = 0                # waiting tasks
+
+        self.results = Queue()
+        self.threads = []
+        self.quit    = False
+
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target = self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Running tasks are completed, waiting tasks are dropped
+        with self.cond:
+            self.quit = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            while thread.is_alive(): thread.join(1.)
+
+
+    def full(self):
+        return self.count + len(self.running) >= self.maxsize
+
+    def submit(self, key, tag, func, *args):
+        task = Task(key, tag, func, args)
+        with self.cond:
+            if key not in self.queues:
+                self.queues[key] = deque()
+                if key not in self.running:
+                    self.ready.append(key)
+            self.queues[key].append(task)
+            self.count += 1
+            self.cond.notify()
+        return task
+
+    def done(self):
+        # Finished tasks, without blocking
+        tasks = []
+        while True:
+            try:
+                tasks.append(self.results.get_nowait())
+            except Empty:
+                return tasks
+
+
+    def lag(self):
+        # Back-pressure: number of waiting and running tasks and the age of
+        # the oldest one in seconds
+        with self.cond:
+            tasks = list(self.running.values())
+            for queue in self.queues.values(): tasks.extend(queue)
+            oldest = min([ task.submitted for task in tasks ] or [now()])
+            return { "waiting" : self.count,
+                     "running" : len(self.running),
+                     "oldest"  : now() - oldest }
+
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.quit:
+                    self.cond.wait()
+                if self.quit: return
+
+                key  = self.ready.popleft()
+                task = self.queues[key].popleft()
+                if not self.queues[key]: del self.queues[key]
+                self.running[key] = task
+                self.count -= 1
+
+            try:
+                task.result = task.func(*task.args)
+            except Exception as error:
+                task.error = error
+
+            with self.cond:
+                del self.running[key]
+                if key in self.queues:
+                    self.ready.append(key)
+                    self.cond.notify()
+
+            self.results.put(task)
+            if self.notify: self.notify("worker")